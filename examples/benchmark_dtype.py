@@ -0,0 +1,62 @@
+'''
+DESCRIPTION~
+
+Measures the per-token decoding cost of the T2S and S2A models for each inference precision
+(fp32, bf16, fp16) on the current device, and shows which one the pipeline picks by default.
+
+PLEASE NOTE~
+
+On CPUs without native bf16 support (AVX512-BF16 or AMX) both bf16 and fp16 are emulated and
+usually slower than fp32, which is why the default policy falls back to fp32 there.
+
+INSTALLATION INSTRUCTIONS~
+
+(1) Create a virtual environment and activate it
+(2) Install pytorch by going to the following website and running the appropriate command for your platform and setup:
+
+https://pytorch.org/get-started/locally/
+
+(3) pip install whisperspeech2
+(4) python benchmark_dtype.py
+'''
+
+import time
+import torch
+from whisperspeech2 import inference
+from whisperspeech2.pipeline import Pipeline
+
+text = "This is a short benchmark sentence that is long enough to measure the cost of every decoding step."
+dtypes = [torch.float32, torch.bfloat16, torch.float16]
+repeats = 3
+
+def sync():
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+
+def per_token(fn):
+    best = None
+    for _ in range(repeats):
+        steps = 0
+        def step():
+            nonlocal steps
+            steps += 1
+        sync()
+        start = time.perf_counter()
+        out = fn(step)
+        sync()
+        cost = (time.perf_counter() - start) / max(steps, 1)
+        best = cost if best is None else min(best, cost)
+    return out, best
+
+device = inference.get_compute_device()
+print(f"device: {device}, threads: {torch.get_num_threads()}, default dtype: {inference.get_inference_dtype(device)}")
+print(f"{'dtype':<16}{'T2S ms/token':>14}{'S2A ms/token':>14}")
+for dtype in dtypes:
+    try:
+        pipe = Pipeline(s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model', dtype=dtype)
+        speaker = pipe._resolve_speaker(None).to(pipe.device)
+        torch.manual_seed(0)
+        stoks, t2s_cost = per_token(lambda step: pipe.t2s.generate(text, step=step, show_progress_bar=False)[0])
+        _, s2a_cost = per_token(lambda step: pipe.s2a.generate(stoks, speaker.unsqueeze(0), step=step, show_progress_bar=False))
+        print(f"{str(dtype):<16}{t2s_cost*1000:>14.2f}{s2a_cost*1000:>14.2f}")
+    except Exception as e:
+        print(f"{str(dtype):<16}{'failed: ' + type(e).__name__:>28}")
@@ -0,0 +1,69 @@
+'''
+DESCRIPTION~
+
+Measures the cost of the top-p filter used by the samplers on S2A-shaped (batch x 4 quantizers x 1026
+codes) and T2S-shaped (batch x 4097 codes) logits. The exact filter sorts the vocabulary once. It is
+compared against an unfiltered baseline, a top-64 truncation (the earlier approximation, which is
+wrong whenever the nucleus holds more than 64 tokens) and a sort-free 64-way threshold search.
+
+INSTALLATION INSTRUCTIONS~
+
+(1) Create a virtual environment and activate it
+(2) Install pytorch by going to the following website and running the appropriate command for your platform and setup:
+
+https://pytorch.org/get-started/locally/
+
+(3) pip install whisperspeech2
+(4) python benchmark_sampling.py
+'''
+
+import time
+import torch
+from whisperspeech2 import inference
+
+top_p = 0.9
+iters = 200
+device = inference.get_compute_device()
+
+def sync():
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+
+def threshold_search(logits, rounds=6, ways=64):
+    p = (logits - logits.logsumexp(-1, keepdim=True)).exp()
+    hi = logits.amax(-1, keepdim=True)
+    lo = logits.amin(-1, keepdim=True) - 1
+    frac = torch.arange(1, ways + 1, device=logits.device, dtype=logits.dtype) / ways
+    for _ in range(rounds):
+        t = lo + (hi - lo) * frac
+        mass = (p.unsqueeze(-2) * (logits.unsqueeze(-2) > t.unsqueeze(-1))).sum(-1)
+        n = (mass >= top_p).sum(-1, keepdim=True)
+        lo = torch.where(n > 0, t.gather(-1, (n - 1).clamp(min=0)), lo)
+        hi = t.gather(-1, n.clamp(max=ways - 1))
+    return logits.masked_fill(logits <= lo, -float("Inf"))
+
+def top64(logits):
+    v = torch.topk(logits, 64).values
+    p = (v - logits.logsumexp(-1, keepdim=True)).exp()
+    pivot = v.gather(-1, ((p.cumsum(-1) - p) < top_p).sum(-1, keepdim=True) - 1)
+    return logits.masked_fill(logits < pivot, -float("Inf"))
+
+variants = {
+    'none': lambda x: x,
+    'sort (exact)': lambda x: inference.filter_logits(x, top_p=top_p),
+    'top-64 (approx)': top64,
+    '64-way search': threshold_search,
+}
+
+def bench(fn, x):
+    for _ in range(10): fn(x)
+    sync()
+    start = time.perf_counter()
+    for _ in range(iters): fn(x)
+    sync()
+    return (time.perf_counter() - start) / iters
+
+print(f"device: {device}")
+print(f"{'shape':<20}" + ''.join(f"{name:>18}" for name in variants))
+for shape in [(1, 4, 1026), (8, 4, 1026), (1, 4097), (8, 4097)]:
+    x = torch.randn(shape, device=device) * 3
+    print(f"{str(shape):<20}" + ''.join(f"{bench(fn, x) * 1e6:>15.1f} us" for fn in variants.values()))
@@ -0,0 +1,62 @@
+'''
+DESCRIPTION~
+
+Compares the pipeline quality tiers. 'full' generates and vocodes every acoustic codebook of the S2A
+model, 'fast' only the first two (Pipeline(quality='fast') or pipe.generate(..., quality='fast')).
+Both tiers start from the same semantic tokens and seed, but the kept codebooks are sampled again as
+well: the decoder sees a fixed start-token embedding in place of every dropped codebook and the
+sampling noise is drawn in a different shape, so the WAV files written next to this script differ in
+the first codebooks too, not only in the dropped ones.
+
+PLEASE NOTE~
+
+The transformer cost per S2A step does not depend on the number of codebooks, the savings come from
+the smaller output head, the shorter delay pattern and the lower vocoder bandwidth. Expect a modest
+speedup and noticeably coarser audio, the tier is meant for shedding load, not as a default.
+
+INSTALLATION INSTRUCTIONS~
+
+(1) Create a virtual environment and activate it
+(2) Install pytorch by going to the following website and running the appropriate command for your platform and setup:
+
+https://pytorch.org/get-started/locally/
+
+(3) pip install whisperspeech2
+(4) python quality_tiers.py
+'''
+
+import time
+import torch
+from whisperspeech2.pipeline import Pipeline, QUALITY_TIERS
+
+text = "This is a short benchmark sentence that is long enough to hear what the quality tiers sound like."
+repeats = 3
+
+def sync():
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+
+pipe = Pipeline(s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model')
+speaker = pipe._resolve_speaker(None).to(pipe.device)
+stoks = pipe.t2s.generate(text, show_progress_bar=False, seed=0)[0]
+
+print(f"{'quality':<10}{'codebooks':>11}{'S2A ms/token':>14}{'vocoder ms':>12}{'total ms':>10}")
+for quality in QUALITY_TIERS:
+    n_quantizers = pipe._n_quantizers(quality)
+    best = None
+    for _ in range(repeats):
+        steps = 0
+        def step():
+            global steps
+            steps += 1
+        sync()
+        start = time.perf_counter()
+        atoks = pipe.s2a.generate(stoks, speaker.unsqueeze(0), step=step, show_progress_bar=False, seed=0, n_quantizers=n_quantizers)
+        sync()
+        mid = time.perf_counter()
+        audio = pipe.vocoder.decode(atoks)
+        sync()
+        end = time.perf_counter()
+        cost = ((mid - start) / max(steps, 1), end - mid, end - start)
+        best = cost if best is None or cost[2] < best[2] else best
+    pipe.vocoder.decode_to_file(f'quality_{quality}.wav', atoks)
+    print(f"{quality:<10}{atoks.shape[1]:>11}{best[0]*1000:>14.2f}{best[1]*1000:>12.2f}{best[2]*1000:>10.1f}")
@@ -0,0 +1,103 @@
+'''
+DESCRIPTION~
+
+Compares int8-quantized T2S and S2A models against the float models: weight memory, per-token
+decoding cost, speedup over the float model and token agreement. Both variants decode greedily from
+the same input, and the S2A models receive the same semantic tokens, so every mismatch comes from
+quantization error.
+
+PLEASE NOTE~
+
+The 'kernel' column shows whether the int8 layers run the fused int8 weight-only matmul
+(torch._weight_int8pack_mm) or fall back to dequantizing the weight on every call. Only the fused
+kernel (or torch_compile=True, which fuses the fallback) reads less memory than the float model.
+Decoding one sequence at a time is bound by weight reads, so that is where the speedup shows up.
+
+INSTALLATION INSTRUCTIONS~
+
+(1) Create a virtual environment and activate it
+(2) Install pytorch by going to the following website and running the appropriate command for your platform and setup:
+
+https://pytorch.org/get-started/locally/
+
+(3) pip install whisperspeech2
+(4) python quantization_report.py
+'''
+
+import time
+import torch
+from whisperspeech2 import inference
+from whisperspeech2.pipeline import Pipeline
+
+s2a_ref = 'collabora/whisperspeech:s2a-q4-tiny-en+pl.model'
+texts = [
+    "This is a short benchmark sentence.",
+    "Quantization should not change what the model says, only how fast it says it.",
+    "The quick brown fox jumps over the lazy dog while the orchestra tunes its instruments.",
+]
+modes = [None, 'int8'] + (['dynamic'] if inference.get_compute_device() == 'cpu' else [])
+repeats = 3
+
+def sync():
+    if torch.cuda.is_available(): torch.cuda.synchronize()
+
+def nbytes(v):
+    if isinstance(v, torch.Tensor): return v.numel() * v.element_size()
+    if isinstance(v, (list, tuple)): return sum(nbytes(x) for x in v)
+    return 0
+
+def weight_bytes(model):
+    return sum(nbytes(v) for k, v in model.state_dict().items() if not k.endswith(('_cache', '_pages')))
+
+def timed(fn):
+    best = None
+    for _ in range(repeats):
+        steps = 0
+        def step():
+            nonlocal steps
+            steps += 1
+        sync()
+        start = time.perf_counter()
+        out = fn(step)
+        sync()
+        cost = (time.perf_counter() - start) / max(steps, 1)
+        best = cost if best is None else min(best, cost)
+    return out, best
+
+def kernel(model):
+    layers = [m for m in model.modules() if hasattr(m, 'use_int8mm')]
+    if not layers: return '-'
+    return 'int8mm' if all(m.use_int8mm for m in layers) else 'dequant'
+
+def agreement(a, b):
+    n = min(a.shape[-1], b.shape[-1])
+    if n == 0: return 1.0
+    return (a[..., :n] == b[..., :n]).float().mean().item()
+
+results = {}
+for mode in modes:
+    pipe = Pipeline(s2a_ref=s2a_ref, quantize=mode)
+    speaker = pipe._resolve_speaker(None).to(pipe.device).unsqueeze(0)
+    stoks, atoks, t2s_cost, s2a_cost = [], [], 0, 0
+    for i, text in enumerate(texts):
+        s, cost = timed(lambda step: pipe.t2s.generate(text, T=0, step=step, show_progress_bar=False)[0])
+        stoks.append(s)
+        t2s_cost += cost / len(texts)
+        ref_stoks = results[None]['stoks'][i] if None in results else s
+        a, cost = timed(lambda step: pipe.s2a.generate(ref_stoks, speaker, T=0, step=step, show_progress_bar=False))
+        atoks.append(a)
+        s2a_cost += cost / len(texts)
+    results[mode] = dict(stoks=stoks, atoks=atoks, t2s_cost=t2s_cost, s2a_cost=s2a_cost, kernel=kernel(pipe.s2a),
+                         t2s_bytes=weight_bytes(pipe.t2s), s2a_bytes=weight_bytes(pipe.s2a))
+    del pipe
+
+base = results[None]
+print(f"{'mode':<10}{'kernel':>9}{'T2S MB':>9}{'S2A MB':>9}{'T2S ms/tok':>12}{'S2A ms/tok':>12}{'T2S speedup':>13}{'S2A speedup':>13}"
+      f"{'T2S agree':>11}{'S2A agree':>11}")
+for mode, r in results.items():
+    t2s_agree = sum(agreement(a, b) for a, b in zip(r['stoks'], base['stoks'])) / len(texts)
+    s2a_agree = sum(agreement(a, b) for a, b in zip(r['atoks'], base['atoks'])) / len(texts)
+    print(f"{str(mode or 'float'):<10}{r['kernel']:>9}{r['t2s_bytes']/2**20:>9.1f}{r['s2a_bytes']/2**20:>9.1f}"
+          f"{r['t2s_cost']*1000:>12.2f}{r['s2a_cost']*1000:>12.2f}"
+          f"{base['t2s_cost']/r['t2s_cost']:>12.2f}x{base['s2a_cost']/r['s2a_cost']:>12.2f}x"
+          f"{t2s_agree:>11.1%}{s2a_agree:>11.1%}")
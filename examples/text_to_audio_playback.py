@@ -16,11 +16,11 @@ https://pytorch.org/get-started/locally/
 (5) python text_to_audio_playback.py
 '''
 
-import numpy as np
 import re
 import threading
 import queue
 from whisperspeech2.pipeline import Pipeline
+from whisperspeech2.audio_writer import PCMBuffer
 import sounddevice as sd
 
 # Uncomment the line for the model you want to use
@@ -42,28 +42,30 @@ sentences = re.split(r'[.!?;]+\s*', input_text)
 
 audio_queue = queue.Queue()
 
+# int16 PCM buffers recycled between the generation and the playback thread
+free_buffers = queue.Queue()
+for _ in range(3): free_buffers.put(PCMBuffer(dtype='int16'))
+
 def process_text_to_audio(sentences, pipe):
-    for sentence in sentences:
-        if sentence:
-            audio_tensor = pipe.generate(sentence, speaker=speaker)
-            audio_np = (audio_tensor.cpu().numpy() * 32767).astype(np.int16)
-            if len(audio_np.shape) == 1:
-                audio_np = np.expand_dims(audio_np, axis=0)
-            else:
-                audio_np = audio_np.T
-            audio_queue.put(audio_np)
+    # T2S, S2A and the vocoder run as separate stages, so the next sentence is
+    # generated while the previous one is still being vocoded
+    for audio_tensor in pipe.generate_pipelined([s for s in sentences if s], speaker=speaker):
+        buffer = free_buffers.get()
+        audio_queue.put((buffer, buffer.fill(audio_tensor)))
     audio_queue.put(None)
 
 def play_audio_from_queue(audio_queue):
     while True:
-        audio_np = audio_queue.get()
-        if audio_np is None:
+        item = audio_queue.get()
+        if item is None:
             break
+        buffer, audio_np = item
         try:
             sd.play(audio_np, samplerate=24000)
             sd.wait()
         except Exception as e:
             print(f"Error playing audio: {e}")
+        free_buffers.put(buffer)
 
 processing_thread = threading.Thread(target=process_text_to_audio, args=(sentences, pipe))
 playback_thread = threading.Thread(target=play_audio_from_queue, args=(audio_queue,))
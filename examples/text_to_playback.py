@@ -23,7 +23,6 @@ https://pytorch.org/get-started/locally/
 
 from whisperspeech2.pipeline import Pipeline
 import sounddevice as sd
-import numpy as np
 
 # Uncomment the line for the model you want to use
 # pipe = Pipeline(s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model')
@@ -36,11 +35,6 @@ This is some sample text. You would add text here that you want spoken and then
 
 # Available speaker presets: "default", "classic", "voice_b"
 # You can also pass a path to an audio file for voice cloning (requires speechbrain)
-audio_tensor = pipe.generate(text, speaker="default")
-audio_np = (audio_tensor.cpu().numpy() * 32767).astype(np.int16)
-if len(audio_np.shape) == 1:
-    audio_np = np.expand_dims(audio_np, axis=0)
-else:
-    audio_np = audio_np.T
+audio_np = pipe.generate_pcm(text, speaker="default", dtype='int16')
 sd.play(audio_np, samplerate=24000)
 sd.wait()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import io
+import wave
+
+import pytest
+
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+
+from whisperspeech2.audio_writer import AudioWriter, BACKENDS, PCMBuffer, encode_audio, write_audio
+
+
+def tone(n=2400):
+    return 0.5 * torch.sin(torch.arange(n) / 10.0)[None]
+
+
+def test_wav_roundtrip(tmp_path):
+    audio = tone()
+    write_audio(tmp_path / 'out.wav', audio)
+    with wave.open(str(tmp_path / 'out.wav')) as w:
+        assert (w.getnchannels(), w.getsampwidth(), w.getframerate()) == (1, 2, 24000)
+        pcm = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+    assert np.abs(pcm / 32767 - audio[0].numpy()).max() < 1e-4
+
+
+def test_streamed_chunks_match_single_write():
+    audio = tone()
+    buf = io.BytesIO()
+    with AudioWriter(buf, 'raw') as w:
+        for chunk in audio.split(700, dim=-1): w.write(chunk)
+    assert buf.getvalue() == encode_audio(audio, 'raw')
+    assert len(buf.getvalue()) == 2 * audio.shape[-1]
+
+
+def test_clipping():
+    pcm = np.frombuffer(encode_audio(torch.tensor([2.0, -2.0, 0.0]), 'raw'), dtype=np.int16)
+    assert pcm.tolist() == [32767, -32767, 0]
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        AudioWriter(tmp_path / 'out.xyz')
+
+
+@pytest.mark.skipif(BACKENDS['flac'] is None, reason="no flac encoder available")
+def test_flac_is_compressed():
+    audio = tone(24000)
+    assert 0 < len(encode_audio(audio, 'flac')) < len(encode_audio(audio, 'wav'))
+
+
+def test_pcm_buffer_reuse():
+    buf = PCMBuffer(dtype='int16')
+    a = buf.fill(tone(100))
+    assert a.dtype == np.int16 and a.shape == (100,)
+    b = buf.fill(tone(50) * 0)
+    assert b.shape == (50,) and not b.any()
+    assert np.shares_memory(a, b)
+    c = buf.fill(tone(1000))
+    assert c.shape == (1000,)
+
+
+def test_pcm_buffer_float():
+    buf = PCMBuffer(dtype='float32')
+    out = buf.fill(np.array([0.25, 3.0, -3.0]))
+    assert out.dtype == np.float32 and out.tolist() == [0.25, 1.0, -1.0]
+    with pytest.raises(ValueError):
+        PCMBuffer(dtype='int32')
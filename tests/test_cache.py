@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.cache import TensorLRUCache, DiskCache, tensor_hash
+
+
+def test_tensor_hash():
+    x = torch.arange(6)
+    assert tensor_hash(x) == tensor_hash(x.clone())
+    assert tensor_hash(x) != tensor_hash(x.reshape(2, 3))
+    assert tensor_hash(x) != tensor_hash(x.to(torch.int32))
+    assert tensor_hash(None) is None
+
+
+def test_lru_eviction():
+    cache = TensorLRUCache(max_bytes=3 * 32)
+    for i in range(3): cache.put(i, torch.zeros(8))
+    assert cache.get(0) is not None
+    cache.put(3, torch.zeros(8))
+    assert cache.get(1) is None
+    assert [k for k in range(4) if cache.get(k) is not None] == [0, 2, 3]
+    assert cache.nbytes == 3 * 32
+    assert cache.stats['evictions'] == 1
+
+
+def test_lru_replace_and_oversized():
+    cache = TensorLRUCache(max_bytes=64)
+    cache.put('a', torch.zeros(8))
+    cache.put('a', torch.zeros(4))
+    assert cache.nbytes == 16 and len(cache) == 1
+    cache.put('b', torch.zeros(100))
+    assert cache.get('b') is None
+    cache.put('c', [torch.zeros(4), torch.zeros(4)])
+    assert cache.nbytes == 48
+
+
+def test_disk_roundtrip(tmp_path):
+    cache = DiskCache(tmp_path)
+    x = torch.arange(10, dtype=torch.long).reshape(2, 5)
+    assert cache.get('atoks', ('m', 1)) is None
+    cache.put('atoks', ('m', 1), x)
+    assert torch.equal(cache.get('atoks', ('m', 1)), x)
+    assert cache.get('stoks', ('m', 1)) is None
+    assert torch.equal(DiskCache(tmp_path).get('atoks', ('m', 1)), x)
+    assert not list(tmp_path.glob('**/*.tmp'))
+
+
+def test_disk_eviction(tmp_path):
+    cache = DiskCache(tmp_path)
+    cache.put('audio', 0, torch.zeros(1000))
+    size = cache.stats['nbytes']
+    cache = DiskCache(tmp_path, max_bytes=int(size * 2.5))
+    cache.put('audio', 1, torch.zeros(1000))
+    os.utime(cache._file('audio', 0), (0, 0))
+    cache.put('audio', 2, torch.zeros(1000))
+    assert cache.get('audio', 0) is None
+    assert cache.get('audio', 1) is not None and cache.get('audio', 2) is not None
+    assert cache.stats['evictions'] == 1
@@ -0,0 +1,39 @@
+from whisperspeech2.chunker import split_paragraphs, split_sentences, chunk_text
+
+
+def test_split_paragraphs():
+    text = "First  paragraph,\nstill the first.\n\n  \nSecond one.\n\n"
+    assert split_paragraphs(text) == ["First paragraph, still the first.", "Second one."]
+
+
+def test_split_sentences():
+    text = 'Hello there. "Is this it?" he asked.  Yes! Done…  ok'
+    assert split_sentences(text) == ["Hello there.", '"Is this it?"', "he asked.", "Yes!", "Done…", "ok"]
+
+
+def test_chunk_text_packs_sentences():
+    text = "One. Two. Three. Four."
+    assert chunk_text(text, max_bytes=10) == ["One. Two.", "Three.", "Four."]
+    assert chunk_text(text, max_bytes=100) == [text]
+
+
+def test_chunk_text_splits_long_sentences():
+    text = "This clause is long, and this one is too; the last part ends here."
+    chunks = chunk_text(text, max_bytes=30)
+    assert all(len(c.encode('utf-8')) <= 30 for c in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_chunk_text_hard_splits_words():
+    chunks = chunk_text("a" * 25, max_bytes=10)
+    assert chunks == ["a" * 10, "a" * 10, "a" * 5]
+
+
+def test_chunk_text_counts_bytes_and_chars():
+    text = "Zażółć gęślą jaźń. Zażółć gęślą jaźń."
+    chunks = chunk_text(text, max_bytes=30)
+    assert all(len(c.encode('utf-8')) <= 30 for c in chunks)
+    assert len(chunks) == 2
+    chunks = chunk_text("one two three four", max_bytes=100, max_chars=9)
+    assert all(len(c) <= 9 for c in chunks)
+    assert " ".join(chunks) == "one two three four"
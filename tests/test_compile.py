@@ -0,0 +1,34 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.inference import CompiledStep
+from whisperspeech2.s2a_delar_mup_wds_mlang import SADelARTransformer
+
+
+def test_compiled_step_counts_new_specializations():
+    torch._dynamo.reset()
+    step = CompiledStep(lambda x, k: x * k + 1, 'cpu')
+    cfg = torch._dynamo.config
+    assert getattr(cfg, 'recompile_limit', getattr(cfg, 'cache_size_limit', None)) >= 64
+    assert torch.equal(step(torch.ones(4), 2), torch.full((4,), 3.0))
+    step.warm = True
+    step(torch.ones(4), 2)
+    assert step.stats == dict(compiled=1, recompiles=0)
+    step(torch.ones(4, dtype=torch.float64), 2)
+    step(torch.ones(4), 3)
+    assert step.stats == dict(compiled=3, recompiles=2)
+
+
+def test_warmup_covers_seeded_generation():
+    torch._dynamo.reset()
+    torch.manual_seed(0)
+    s2a = SADelARTransformer(depth=2, n_head=2, head_width=32, ffn_mult=1, ctx_n=96, stoks_len=32, stoks_codes=33, quantizers=4)
+    s2a.eval()
+    s2a.optimize(max_batch_size=1, dtype=torch.float32, torch_compile=True)
+    s2a.warmup()
+    stoks = torch.randint(0, 32, (10,))
+    speaker = torch.randn(1, s2a.width)
+    s2a.generate(stoks, speaker, show_progress_bar=False, seed=0)
+    s2a.generate(stoks, speaker, show_progress_bar=False)
+    assert s2a.compiled_step.stats['recompiles'] == 0
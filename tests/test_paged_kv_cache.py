@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.modules import PagedKVCache
+
+
+def test_reserve_and_release():
+    pool = PagedKVCache(8, block_size=4)
+    a, b = pool.allocate(2)
+    assert pool.free_blocks == 7
+    pool.reserve([a], 9)
+    pool.reserve([b], 1)
+    assert pool.free_blocks == 3
+    assert 0 not in pool._tables[a] + pool._tables[b]
+    pool.reserve([a], 12)
+    assert pool.free_blocks == 3
+    pool.release([a])
+    assert pool.free_blocks == 6
+
+
+def test_exhaustion():
+    pool = PagedKVCache(4, block_size=4)
+    a, = pool.allocate(1)
+    with pytest.raises(RuntimeError):
+        pool.reserve([a], 17)
+    assert pool.free_blocks == 3
+
+
+def test_block_table_padding():
+    pool = PagedKVCache(8, block_size=4)
+    a, b = pool.allocate(2)
+    pool.reserve([a], 10)
+    pool.reserve([b], 2)
+    pool.activate([a, None, b])
+    table = pool.block_table
+    assert table.shape == (3, 3)
+    assert table[0].tolist() == pool._tables[a]
+    assert table[1].tolist() == [0, 0, 0]
+    assert table[2].tolist() == pool._tables[b] + [0, 0]
+    pool.release([a])
+    assert pool.block_table.shape == (3, 1)
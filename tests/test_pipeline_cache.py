@@ -0,0 +1,79 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.cache import TensorLRUCache
+from whisperspeech2.pipeline import Pipeline
+
+
+class FakeT2S:
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, text, cps=15, lang='en', step=None, show_progress_bar=True, seed=None):
+        self.calls.append((text, seed, show_progress_bar))
+        if step is not None: step()
+        return [torch.arange(len(text))]
+
+
+class FakeS2A:
+    quantizers = 4
+
+    def __init__(self):
+        self.calls = 0
+        self.seeds = []
+
+    def generate(self, stoks, speakers, step=None, show_progress_bar=True, seed=None, **kwargs):
+        self.seeds.append(seed)
+        if step is not None: step()
+        return torch.full((1, 4, 10), len(stoks))
+
+    def generate_stream(self, stoks, speakers, chunk_size=50, **kwargs):
+        self.calls += 1
+        atoks = torch.arange(4 * 30).reshape(1, 4, 30)
+        yield from atoks.split(chunk_size, dim=-1)
+        return atoks
+
+
+class FakeVocoder:
+    def decode(self, atoks):
+        return atoks.float()
+
+    def decode_stream(self, chunks, *args):
+        for chunk in chunks: yield chunk.float()
+
+
+def make_pipe():
+    pipe = Pipeline.__new__(Pipeline)
+    pipe.t2s, pipe.s2a, pipe.vocoder, pipe.t2s_draft = FakeT2S(), FakeS2A(), FakeVocoder(), None
+    pipe.t2s_id, pipe.s2a_id = 't2s', 's2a'
+    pipe.stoks_cache, pipe.atoks_cache, pipe.disk_cache = TensorLRUCache(2**20), TensorLRUCache(2**20), None
+    pipe.eos_patience, pipe.quality, pipe.device = None, 'full', 'cpu'
+    return pipe
+
+
+def test_stream_uses_atoks_cache():
+    pipe = make_pipe()
+    speaker = torch.zeros(192)
+    first = torch.cat(list(pipe.generate_stream("hello", speaker, chunk_frames=8)), dim=-1)
+    second = torch.cat(list(pipe.generate_stream("hello", speaker, chunk_frames=8)), dim=-1)
+    assert pipe.s2a.calls == 1
+    assert torch.equal(first, second)
+    assert pipe.cache_stats['atoks']['hits'] == 1
+
+
+def test_abandoned_stream_is_not_cached():
+    pipe = make_pipe()
+    speaker = torch.zeros(192)
+    next(pipe.generate_stream("hello", speaker, chunk_frames=8))
+    assert len(pipe.atoks_cache) == 0
+
+
+def test_pipelined_passes_seed_and_step_callback():
+    pipe = make_pipe()
+    steps = []
+    audio = list(pipe.generate_pipelined(["a", "bb", "ccc"], torch.zeros(192), step_callback=lambda: steps.append(1), seed=7))
+    assert [a[0, 0, 0].item() for a in audio] == [1, 2, 3]
+    assert pipe.t2s.calls == [("a", 7, False), ("bb", 8, False), ("ccc", 9, False)]
+    assert pipe.s2a.seeds == [7, 8, 9]
+    assert len(steps) == 6
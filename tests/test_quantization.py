@@ -0,0 +1,30 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch import nn
+from whisperspeech2.modules import Int8Linear, quantize_linears
+
+
+@pytest.mark.parametrize('use_int8mm', [False, True])
+def test_int8_linear_matches_float(use_int8mm):
+    torch.manual_seed(0)
+    linear = nn.Linear(64, 48)
+    q = Int8Linear.from_linear(linear)
+    if use_int8mm and not q.use_int8mm: pytest.skip("no fused int8 matmul in this PyTorch build")
+    q.use_int8mm = use_int8mm
+    assert q.weight.dtype == torch.int8
+    x = torch.randn(2, 5, 64)
+    ref = linear(x)
+    out = q(x)
+    assert out.shape == ref.shape
+    assert (out - ref).abs().max() < 0.02 * ref.abs().max()
+
+
+def test_quantize_linears_skips_embeddings():
+    model = nn.ModuleDict(dict(emb_proj=nn.Linear(8, 8), mlp=nn.Sequential(nn.Linear(8, 8), nn.GELU())))
+    quantize_linears(model, 'int8')
+    assert type(model['emb_proj']) is nn.Linear
+    assert type(model['mlp'][0]) is Int8Linear
+    with pytest.raises(ValueError):
+        quantize_linears(nn.Sequential(nn.Linear(4, 4)), 'int4')
@@ -0,0 +1,88 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.s2a_delar_mup_wds_mlang import SADelARTransformer
+
+
+@pytest.fixture(scope='module')
+def s2a():
+    torch.manual_seed(0)
+    model = SADelARTransformer(depth=2, n_head=2, head_width=32, ffn_mult=1, ctx_n=96, stoks_len=32, stoks_codes=33, quantizers=4)
+    model.eval()
+    model.optimize(max_batch_size=2, dtype=torch.float32)
+    return model
+
+
+def run(fn):
+    steps = 0
+    def step():
+        nonlocal steps
+        steps += 1
+    return fn(step), steps
+
+
+@pytest.mark.parametrize('n_quantizers', [None, 2])
+def test_delay_steps_follow_quantizers(s2a, n_quantizers):
+    stoks = torch.randint(0, 32, (20,))
+    speaker = torch.randn(1, s2a.width)
+    atoks, steps = run(lambda step: s2a.generate(stoks, speaker, step=step, show_progress_bar=False, seed=0, n_quantizers=n_quantizers))
+    q = n_quantizers or s2a.quantizers
+    n = 3 * len(stoks) - 4
+    assert atoks.shape == (1, q, n)
+    # one prefill step, then positions 2 .. n+q-1
+    assert steps == n + q - 2
+    batch, steps = run(lambda step: s2a.generate_batch([stoks, stoks[:10]], speaker.expand(2, -1), step=step, show_progress_bar=False, n_quantizers=n_quantizers))
+    assert [a.shape for a in batch] == [(q, n), (q, 26)]
+    assert steps == n + q - 2
+
+
+def test_invalid_quantizers(s2a):
+    with pytest.raises(ValueError):
+        s2a.generate(torch.randint(0, 32, (4,)), torch.randn(1, s2a.width), show_progress_bar=False, n_quantizers=5)
+
+
+@pytest.mark.parametrize('eos_patience', [None, 2, 12])
+def test_stream_matches_generate(s2a, eos_patience):
+    stoks = torch.randint(0, 32, (20,))
+    speaker = torch.randn(1, s2a.width)
+    full = s2a.generate(stoks, speaker, show_progress_bar=False, seed=0, eos_patience=eos_patience)
+    chunks = list(s2a.generate_stream(stoks, speaker, chunk_size=5, seed=0, eos_patience=eos_patience))
+    assert torch.equal(torch.cat(chunks, dim=-1), full)
+
+
+def test_abandoned_stream_releases_the_model():
+    torch.manual_seed(0)
+    model = SADelARTransformer(depth=2, n_head=2, head_width=32, ffn_mult=1, ctx_n=96, stoks_len=32, stoks_codes=33, quantizers=4)
+    model.eval()
+    model.optimize(max_batch_size=2, dtype=torch.float32, kv_cache_blocks=32, kv_block_size=16)
+    stoks = torch.randint(0, 32, (20,))
+    speaker = torch.randn(1, model.width)
+    free = model.kv_pool.free_blocks
+    stream = model.generate_stream(stoks, speaker, chunk_size=5, seed=0)
+    next(stream)
+    with pytest.raises(RuntimeError):
+        model.generate(stoks, speaker, show_progress_bar=False)
+    stream.close()
+    assert model.kv_pool.free_blocks == free
+    model.generate(stoks, speaker, show_progress_bar=False)
+    assert model.kv_pool.free_blocks == free
+
+
+def test_dropped_codebooks_embed_as_start_token(s2a):
+    toks = torch.randint(0, s2a.codes, (1, 2, 10))
+    padded = torch.cat([toks, torch.full((1, s2a.quantizers - 2, 10), s2a.codes + 1)], dim=1)
+    xenc = torch.zeros((1, 1, s2a.width))
+    assert torch.allclose(s2a.embds(toks, xenc), s2a.embds(padded, xenc))
+
+
+def test_seeded_batch_matches_single_with_length_buckets():
+    torch.manual_seed(0)
+    model = SADelARTransformer(depth=2, n_head=2, head_width=32, ffn_mult=1, ctx_n=96, stoks_len=32, stoks_codes=33, quantizers=4)
+    model.eval()
+    model.optimize(max_batch_size=2, dtype=torch.float32, length_buckets=[12, 24])
+    short, long = torch.randint(0, 32, (8,)), torch.randint(0, 32, (20,))
+    speaker = torch.randn(1, model.width)
+    single = model.generate(short, speaker, show_progress_bar=False, seed=5)
+    batch = model.generate_batch([long, short], speaker.expand(2, -1), show_progress_bar=False, seed=[4, 5])
+    assert torch.equal(batch[1], single[0])
@@ -0,0 +1,35 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.inference import filter_logits
+
+
+def sorted_top_p(logits, top_p):
+    v, idx = logits.sort(-1, descending=True)
+    p = v.softmax(-1)
+    keep = (p.cumsum(-1) - p) < top_p
+    return torch.zeros_like(keep).scatter(-1, idx, keep)
+
+
+@pytest.mark.parametrize('scale', [0.1, 1.0, 5.0])
+@pytest.mark.parametrize('top_p', [0.1, 0.5, 0.9, 0.99])
+def test_top_p_matches_sort(scale, top_p):
+    torch.manual_seed(0)
+    # small scales give flat distributions whose nucleus holds hundreds of the 1026 codes
+    logits = torch.randn(3, 4, 1026) * scale
+    kept = filter_logits(logits, top_p=top_p).isfinite()
+    assert torch.equal(kept, sorted_top_p(logits, top_p))
+
+
+def test_top_p_with_masked_logits():
+    logits = torch.tensor([[3.0, 2.0, -float('inf'), 1.0, 0.0]])
+    kept = filter_logits(logits, top_p=0.8).isfinite()
+    assert kept.tolist() == [[True, True, False, False, False]]
+
+
+def test_top_k_and_min_p():
+    logits = torch.tensor([[4.0, 3.0, 2.0, 1.0]])
+    assert filter_logits(logits, top_k=2).isfinite().tolist() == [[True, True, False, False]]
+    assert filter_logits(logits, top_k=3, top_p=0.5).isfinite().tolist() == [[True, False, False, False]]
+    assert filter_logits(logits, min_p=0.3).isfinite().tolist() == [[True, True, False, False]]
@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from whisperspeech2.pipeline import Pipeline
+from whisperspeech2.scheduler import Scheduler
+from whisperspeech2.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech2.s2a_delar_mup_wds_mlang import SADelARTransformer
+
+
+def make_pipe(kv_cache_blocks=None):
+    torch.manual_seed(0)
+    t2s = TSARTransformer(depth=2, n_head=2, head_width=32, ffn_mult=1, ttoks_len=64, stoks_len=24, stoks_codes=32)
+    s2a = SADelARTransformer(depth=2, n_head=2, head_width=32, ffn_mult=1, ctx_n=96, stoks_len=32, stoks_codes=33, quantizers=4)
+    for m in (t2s, s2a):
+        m.eval()
+        m.optimize(max_batch_size=2, dtype=torch.float32, kv_cache_blocks=kv_cache_blocks, kv_block_size=16)
+    pipe = Pipeline.__new__(Pipeline)
+    pipe.t2s, pipe.s2a, pipe.vocoder = t2s, s2a, None
+    pipe.eos_patience, pipe.quality = None, 'full'
+    return pipe
+
+
+# three requests on two slots: the third one runs while a freed slot sits idle after a long request
+@pytest.mark.parametrize('kv_cache_blocks', [None, 64])
+def test_mixed_length_requests(kv_cache_blocks):
+    pipe = make_pipe(kv_cache_blocks)
+    speaker = torch.randn(pipe.s2a.width)
+    texts = ["A somewhat longer sentence for the first slot.", "Hi.", "The third request, admitted after the others finish."]
+    with Scheduler(pipe, max_batch_size=2, vocode=False) as sched:
+        futures = [sched.submit(t, speaker, seed=i) for i, t in enumerate(texts)]
+        results = [f.result(timeout=600) for f in futures]
+    for atoks in results:
+        assert atoks.shape[0] == pipe.s2a.quantizers
+        assert atoks.shape[-1] <= 3 * (pipe.t2s.stoks_len - 1)
+    assert all(r is None for r in sched.t2s_slots + sched.s2a_slots)
+    assert (sched.t2s_pos == 0).all() and (sched.s2a_pos == 0).all()
@@ -0,0 +1,41 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('vocos')
+
+from whisperspeech2.a2wav import Vocoder
+
+# largest absolute sample difference allowed between streamed and full decodes (fp32, audio in [-1, 1])
+TOLERANCE = 1e-4
+
+
+@pytest.fixture(scope='module')
+def vocoder():
+    try:
+        return Vocoder(device='cpu')
+    except Exception as e:
+        pytest.skip(f"Vocos weights are not available: {e}")
+
+
+def test_receptive_field(vocoder):
+    # kernel 7 embedding conv + 8 kernel 7 ConvNeXt blocks + the ISTFT overlap
+    assert vocoder.receptive_field >= 29
+
+
+@pytest.mark.parametrize('chunk', [1, 13, 50])
+def test_stream_matches_full_decode(vocoder, chunk):
+    torch.manual_seed(0)
+    atoks = torch.randint(0, 1024, (1, 4, 240))
+    full = vocoder.decode(atoks)
+    streamed = torch.cat(list(vocoder.decode_stream(atoks.split(chunk, dim=-1))), dim=-1)
+    assert streamed.shape == full.shape
+    assert (streamed - full).abs().max() < TOLERANCE
+
+
+def test_short_context_differs(vocoder):
+    # sanity check that the comparison above can fail: too little context leaves seams
+    torch.manual_seed(0)
+    atoks = torch.randint(0, 1024, (1, 4, 240))
+    full = vocoder.decode(atoks)
+    streamed = torch.cat(list(vocoder.decode_stream(atoks.split(20, dim=-1), context_frames=2, lookahead_frames=1)), dim=-1)
+    assert (streamed - full).abs().max() > TOLERANCE
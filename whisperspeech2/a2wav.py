@@ -2,8 +2,9 @@ __all__ = ['Vocoder']
 
 from vocos import Vocos
 from whisperspeech2 import inference
+from whisperspeech2.audio_writer import write_audio
 import torch
-import numpy as np
+from pathlib import Path
 
 class Vocoder:
     def __init__(self, repo_id="charactr/vocos-encodec-24khz", device=None, cache_dir=None):
@@ -11,6 +12,16 @@ class Vocoder:
         if device == 'mps': device = 'cpu'
         self.device = device
         self.vocos = Vocos.from_pretrained(repo_id).to(device)
+        self.hop_length = self.vocos.head.istft.hop_length
+        self.receptive_field = self._receptive_field()
+
+    def _receptive_field(self):
+        # frames on each side that influence one output frame: the embedding conv and the ConvNeXt depthwise convs,
+        # plus the ISTFT window overlap
+        backbone, istft = self.vocos.backbone, self.vocos.head.istft
+        convs = [backbone.embed] + [block.dwconv for block in backbone.convnext]
+        frames = sum(c.dilation[0] * (c.kernel_size[0] // 2) for c in convs)
+        return frames + -(-getattr(istft, 'win_length', istft.n_fft) // (2 * istft.hop_length))
 
     def is_notebook(self):
         try:
@@ -30,52 +41,63 @@ class Vocoder:
         bandwidth_id = torch.tensor({2: 0, 4: 1, 8: 2}[q]).to(self.device)
         return self.vocos.decode(features, bandwidth_id=bandwidth_id)
 
-    def _save_audio(self, fname, audio_tensor, sample_rate=24000):
-        audio_np = audio_tensor.cpu().numpy()
-        if audio_np.ndim > 1:
-            audio_np = audio_np.squeeze()
+    @torch.no_grad()
+    def decode_batch(self, atoks):
+        atoks = [a.reshape(a.shape[-2:]).to(self.device) for a in atoks]
+        if not atoks: return []
+        lengths = [a.shape[-1] for a in atoks]
+        T = max(lengths)
+        padded = [a if t == T else torch.cat([a, (a[:,-1:] if t else a.new_zeros(a.shape[0], 1)).expand(-1, T - t)], dim=-1)
+                  for a, t in zip(atoks, lengths)]
+        audio = self.decode(torch.stack(padded))
+        return [audio[i:i+1,:t*self.hop_length] for i, t in enumerate(lengths)]
 
-        try:
-            import av
-            output = av.open(str(fname), mode='w')
-            stream = output.add_stream('pcm_s16le', rate=sample_rate, layout='mono')
-            audio_int16 = (np.clip(audio_np, -1.0, 1.0) * 32767).astype(np.int16)
-            frame = av.AudioFrame.from_ndarray(audio_int16.reshape(1, -1), format='s16', layout='mono')
-            frame.sample_rate = sample_rate
-            for pkt in stream.encode(frame):
-                output.mux(pkt)
-            for pkt in stream.encode(None):
-                output.mux(pkt)
-            output.close()
-            return
-        except ImportError:
-            pass
+    def _decode_window(self, window, start, begin, end=None):
+        audio = self.decode(window)
+        offset = start * self.hop_length
+        return audio[..., begin - offset:None if end is None else end - offset]
 
-        try:
-            import soundfile as sf
-            sf.write(str(fname), audio_np, sample_rate)
-            return
-        except ImportError:
-            pass
+    def _crossfade(self, audio, tail, crossfade):
+        if tail is not None:
+            n = tail.shape[-1]
+            fade = torch.linspace(0, 1, n, device=audio.device, dtype=audio.dtype)
+            audio = torch.cat([tail * (1 - fade) + audio[..., :n] * fade, audio[..., n:]], dim=-1)
+        if crossfade and audio.shape[-1] > crossfade:
+            return audio[..., :-crossfade], audio[..., -crossfade:]
+        return audio, None
 
-        try:
-            import torchaudio
-            torchaudio.save(str(fname), audio_tensor, sample_rate)
-            return
-        except (ImportError, RuntimeError):
-            pass
+    @torch.no_grad()
+    def decode_stream(self, chunks, context_frames=None, lookahead_frames=None, crossfade=256):
+        hop = self.hop_length
+        # with the full receptive field on both sides every emitted sample matches a full decode,
+        # the crossfaded tail reaches crossfade samples further back
+        if context_frames is None: context_frames = self.receptive_field + -(-crossfade // hop)
+        if lookahead_frames is None: lookahead_frames = self.receptive_field
+        crossfade = min(crossfade, context_frames * hop)
+        # buf holds the frames [start, start + buf.shape[-1]), audio is final up to frame `emitted` minus the held back tail
+        buf, start, emitted, tail = None, 0, 0, None
+        for chunk in chunks:
+            buf = chunk if buf is None else torch.cat([buf, chunk.to(buf.device)], dim=-1)
+            ready = start + buf.shape[-1] - lookahead_frames
+            if ready <= emitted: continue
+            pending = 0 if tail is None else tail.shape[-1]
+            audio, tail = self._crossfade(self._decode_window(buf, start, emitted * hop - pending, ready * hop), tail, crossfade)
+            if audio.shape[-1]: yield audio
+            emitted = ready
+            keep = max(start, emitted - context_frames)
+            buf, start = buf[..., keep - start:], keep
+        if buf is None: return
+        pending = 0 if tail is None else tail.shape[-1]
+        audio, _ = self._crossfade(self._decode_window(buf, start, emitted * hop - pending), tail, 0)
+        if audio.shape[-1]: yield audio
 
-        raise ImportError(
-            "No audio saving backend available. Please install PyAV or soundfile:\n"
-            "  pip install av\n"
-            "or\n"
-            "  pip install soundfile"
-        )
+    def _save_audio(self, fname, audio_tensor, sample_rate=24000, format=None):
+        write_audio(fname, audio_tensor, format, sample_rate=sample_rate, input_rate=24000)
 
-    def decode_to_file(self, fname, atoks):
+    def decode_to_file(self, fname, atoks, format=None, sample_rate=24000):
         audio = self.decode(atoks)
-        self._save_audio(fname, audio.cpu(), 24000)
-        if self.is_notebook():
+        self._save_audio(fname, audio.cpu(), sample_rate, format)
+        if isinstance(fname, (str, Path)) and self.is_notebook():
             from IPython.display import display, HTML, Audio
             display(HTML(f'<a href="{fname}" target="_blank">Listen to {fname}</a>'))
 
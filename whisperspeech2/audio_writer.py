@@ -0,0 +1,160 @@
+__all__ = ['PCMBuffer', 'AudioWriter', 'write_audio', 'encode_audio', 'FORMATS', 'BACKENDS']
+
+import io
+import wave
+from fractions import Fraction
+from pathlib import Path
+
+import numpy as np
+import torch
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+_AV_FORMATS = {'flac': ('flac', 'flac'), 'mp3': ('mp3', 'libmp3lame'), 'opus': ('ogg', 'libopus')}
+_SF_FORMATS = {'flac': ('FLAC', 'PCM_16'), 'mp3': ('MP3', 'MPEG_LAYER_III'), 'opus': ('OGG', 'OPUS')}
+
+def _soundfile_supports(fmt):
+    if soundfile is None: return False
+    container, subtype = _SF_FORMATS[fmt]
+    return container in soundfile.available_formats() and subtype in soundfile.available_subtypes(container)
+
+FORMATS = ('wav', 'raw', 'flac', 'mp3', 'opus')
+BACKENDS = {fmt: 'builtin' if fmt in ('wav', 'raw') else 'av' if av is not None else 'soundfile' if _soundfile_supports(fmt) else None
+            for fmt in FORMATS}
+
+class PCMBuffer:
+    def __init__(self, capacity=0, dtype='int16'):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.int16, np.float32): raise ValueError(f"unsupported PCM dtype: {self.dtype}")
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        pin = torch.cuda.is_available()
+        self._scratch = torch.empty(capacity, dtype=torch.float32, pin_memory=pin)
+        self._out = self._scratch if self.dtype == np.float32 else torch.empty(capacity, dtype=torch.int16)
+        self.array = self._out.numpy()
+
+    def fill(self, audio):
+        if not isinstance(audio, torch.Tensor): audio = torch.from_numpy(np.asarray(audio, dtype=np.float32))
+        audio = audio.detach().reshape(-1)
+        n = audio.shape[0]
+        if n > self._scratch.shape[0]: self._alloc(max(n, 2 * self._scratch.shape[0]))
+        scratch = self._scratch[:n]
+        scratch.copy_(audio)
+        scratch.clamp_(-1.0, 1.0)
+        if self.dtype == np.int16:
+            scratch.mul_(32767)
+            self._out[:n].copy_(scratch)
+        return self.array[:n]
+
+class _RawSink:
+    def __init__(self, f, sample_rate):
+        self.f = f
+
+    def write(self, pcm):
+        self.f.write(pcm.data)
+
+    def close(self):
+        pass
+
+class _WaveSink:
+    def __init__(self, f, sample_rate):
+        self.w = wave.open(f, 'wb')
+        self.w.setnchannels(1)
+        self.w.setsampwidth(2)
+        self.w.setframerate(sample_rate)
+
+    def write(self, pcm):
+        self.w.writeframesraw(pcm.data)
+
+    def close(self):
+        self.w.close()
+
+class _AVSink:
+    def __init__(self, f, fmt, sample_rate, input_rate, bitrate):
+        container, codec = _AV_FORMATS[fmt]
+        self.out = av.open(f, mode='w', format=container)
+        self.stream = self.out.add_stream(codec, rate=sample_rate, layout='mono')
+        if bitrate: self.stream.bit_rate = bitrate
+        self.input_rate = input_rate
+        self.samples = 0
+
+    def write(self, pcm):
+        frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = self.input_rate
+        frame.time_base = Fraction(1, self.input_rate)
+        frame.pts = self.samples
+        self.samples += len(pcm)
+        for pkt in self.stream.encode(frame): self.out.mux(pkt)
+
+    def close(self):
+        for pkt in self.stream.encode(None): self.out.mux(pkt)
+        self.out.close()
+
+class _SoundfileSink:
+    def __init__(self, f, fmt, sample_rate):
+        container, subtype = _SF_FORMATS[fmt]
+        self.f = soundfile.SoundFile(f, 'w', samplerate=sample_rate, channels=1, format=container, subtype=subtype)
+
+    def write(self, pcm):
+        self.f.write(pcm)
+
+    def close(self):
+        self.f.close()
+
+class AudioWriter:
+    def __init__(self, dest, format=None, sample_rate=24000, input_rate=24000, bitrate=None):
+        if format is None:
+            format = Path(dest).suffix.lstrip('.').lower() if isinstance(dest, (str, Path)) else 'wav'
+            if format == 'ogg': format = 'opus'
+        if format not in FORMATS: raise ValueError(f"unsupported audio format: {format} (expected one of {', '.join(FORMATS)})")
+        backend = BACKENDS[format]
+        if backend is None:
+            raise ImportError(f"Encoding {format} needs PyAV or a soundfile build with {format} support:\n"
+                              "  pip install av")
+        if sample_rate != input_rate and backend != 'av':
+            raise ValueError("Resampling while encoding needs PyAV (pip install av)")
+        self._file = open(dest, 'wb') if isinstance(dest, (str, Path)) and backend == 'builtin' else None
+        f = self._file or (str(dest) if isinstance(dest, Path) else dest)
+        if backend == 'builtin':
+            self.sink = _RawSink(f, sample_rate) if format == 'raw' else _WaveSink(f, sample_rate)
+        elif backend == 'av':
+            self.sink = _AVSink(f, format, sample_rate, input_rate, bitrate)
+        else:
+            self.sink = _SoundfileSink(f, format, sample_rate)
+        self.format = format
+        self.sample_rate = sample_rate
+        self._pcm = PCMBuffer(dtype='int16')
+
+    def write(self, audio):
+        pcm = self._pcm.fill(audio)
+        if len(pcm): self.sink.write(pcm)
+
+    def close(self):
+        try:
+            self.sink.close()
+        finally:
+            if self._file is not None: self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_audio(dest, audio, format=None, sample_rate=24000, input_rate=24000, bitrate=None):
+    with AudioWriter(dest, format, sample_rate, input_rate, bitrate) as w:
+        w.write(audio)
+
+def encode_audio(audio, format='wav', sample_rate=24000, input_rate=24000, bitrate=None):
+    buf = io.BytesIO()
+    write_audio(buf, audio, format, sample_rate, input_rate, bitrate)
+    return buf.getvalue()
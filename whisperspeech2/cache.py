@@ -0,0 +1,149 @@
+__all__ = ['TensorLRUCache', 'DiskCache', 'tensor_hash', 'model_fingerprint']
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def tensor_hash(x):
+    if x is None: return None
+    x = x.detach().cpu().contiguous()
+    h = hashlib.sha1(str((x.dtype, tuple(x.shape))).encode())
+    h.update(x.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def model_fingerprint(model):
+    h = hashlib.sha1(type(model).__name__.encode())
+    for name, p in model.named_parameters():
+        h.update(name.encode())
+        h.update(tensor_hash(p).encode())
+    return h.hexdigest()
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor): return value.element_size() * value.numel()
+    if isinstance(value, (list, tuple)): return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class TensorLRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes: return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None: self.nbytes -= _nbytes(old)
+            self._data[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= _nbytes(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self):
+        return dict(entries=len(self._data), nbytes=self.nbytes, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class DiskCache:
+    def __init__(self, path, max_bytes=None):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._size = sum(f.stat().st_size for f in self._files())
+
+    def _files(self):
+        return self.path.glob('*/*/*.npy')
+
+    def _file(self, kind, key):
+        h = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.path / kind / h[:2] / f'{h}.npy'
+
+    def get(self, kind, key, device=None):
+        fname = self._file(kind, key)
+        try:
+            value = np.load(fname, mmap_mode='c')
+            os.utime(fname)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = torch.from_numpy(value)
+        return value if device is None else value.to(device)
+
+    def put(self, kind, key, value):
+        fname = self._file(kind, key)
+        if fname.exists(): return
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=fname.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f: np.save(f, value.detach().cpu().numpy())
+            os.replace(tmp, fname)
+        except BaseException:
+            if os.path.exists(tmp): os.unlink(tmp)
+            raise
+        with self._lock:
+            self._size += fname.stat().st_size
+            if self.max_bytes and self._size > self.max_bytes: self._evict()
+
+    def _evict(self):
+        files = []
+        for f in self._files():
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        files.sort()
+        self._size = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, f in files:
+            if self._size <= target: break
+            try:
+                f.unlink()
+            except OSError:
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        return dict(nbytes=self._size, hits=self.hits, misses=self.misses, evictions=self.evictions)
@@ -0,0 +1,52 @@
+__all__ = ['split_paragraphs', 'split_sentences', 'chunk_text']
+
+import re
+
+_sentence_end = re.compile(r'(?:(?<=[.!?…。！？])|(?<=[.!?…。！？]["\')\]]))\s+')
+_clause_end = re.compile(r'(?<=[,;:—–])\s+')
+
+def _nbytes(s):
+    return len(s.encode('utf-8'))
+
+def split_paragraphs(text):
+    return [p for p in (re.sub(r'\s+', ' ', p).strip() for p in re.split(r'\n\s*\n', text)) if p]
+
+def split_sentences(text):
+    return [s.strip() for s in _sentence_end.split(re.sub(r'\s+', ' ', text)) if s.strip()]
+
+def _fits(s, max_bytes, max_chars):
+    return _nbytes(s) <= max_bytes and (max_chars is None or len(s) <= max_chars)
+
+def _pack(pieces, max_bytes, max_chars):
+    chunks, cur = [], ''
+    for p in pieces:
+        candidate = f'{cur} {p}' if cur else p
+        if _fits(candidate, max_bytes, max_chars):
+            cur = candidate
+        else:
+            if cur: chunks.append(cur)
+            cur = p
+    if cur: chunks.append(cur)
+    return chunks
+
+def _hard_split(s, max_bytes, max_chars):
+    chunks, cur = [], ''
+    for c in s:
+        if not _fits(cur + c, max_bytes, max_chars):
+            chunks.append(cur)
+            cur = ''
+        cur += c
+    if cur: chunks.append(cur)
+    return chunks
+
+def _split_long(s, max_bytes, max_chars):
+    if _fits(s, max_bytes, max_chars): return [s]
+    for splitter in (_clause_end.split, str.split):
+        pieces = splitter(s)
+        if len(pieces) > 1:
+            return [c for p in pieces for c in _split_long(p, max_bytes, max_chars)]
+    return _hard_split(s, max_bytes, max_chars)
+
+def chunk_text(text, max_bytes, max_chars=None):
+    pieces = [p for s in split_sentences(text) for p in _split_long(s, max_bytes, max_chars)]
+    return _pack(pieces, max_bytes, max_chars)
@@ -1,5 +1,7 @@
-__all__ = ['get_compute_device']
+__all__ = ['get_compute_device', 'get_inference_dtype', 'cpu_supports_bf16', 'bucket_length', 'batch_bucket', 'CompiledStep',
+           'make_seeds', 'make_generators', 'exponential_noise', 'filter_logits', 'gumbel_sample', 'compile_sampler']
 
+import math
 import torch
 import torch.nn.functional as F
 from huggingface_hub import hf_hub_download
@@ -21,6 +23,23 @@ def get_compute_device():
     if preferred_device is None: preferred_device = get_default_compute_device()
     return preferred_device
 
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo') as f: flags = f.read()
+        if 'avx512_bf16' in flags or 'amx_bf16' in flags: return True
+    except OSError:
+        pass
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def get_inference_dtype(device=None):
+    device = str(device or get_compute_device())
+    if device.startswith('cpu'):
+        return torch.bfloat16 if cpu_supports_bf16() else torch.float32
+    return torch.float16
+
 def load_model(ref=None, spec=None, device='cpu', cache_dir=None):
     if spec is not None: return spec
     if ":" in ref:
@@ -30,25 +49,97 @@ def load_model(ref=None, spec=None, device='cpu', cache_dir=None):
         local_filename = ref
     return torch.load(local_filename, map_location=device)
 
+def bucket_length(n, buckets, max_len):
+    for b in sorted(buckets or []):
+        if n <= b: return min(b, max_len)
+    return max_len
+
+def batch_bucket(n, buckets):
+    return next((b for b in sorted(buckets or []) if b >= n), n)
+
+class CompiledStep:
+    def __init__(self, fn, device='cuda', max_variants=64):
+        mode = "reduce-overhead" if str(device).startswith('cuda') else "default"
+        self.fn = torch.compile(fn, mode=mode, fullgraph=True, dynamic=False)
+        self.keys = set()
+        self.warm = False
+        self.recompiles = 0
+        # every batch size, encoder length and sampling setting is a separate specialization of the same frame,
+        # past the default limit of 8 dynamo would silently fall back to eager
+        cfg = torch._dynamo.config
+        limit_name = 'recompile_limit' if hasattr(cfg, 'recompile_limit') else 'cache_size_limit'
+        setattr(cfg, limit_name, max(getattr(cfg, limit_name), max_variants))
+
+    def __call__(self, *args):
+        # with dynamic=False dynamo guards on tensor shapes and dtypes and on plain python values, so a new key is a new compilation
+        key = tuple((tuple(a.shape), a.dtype) if isinstance(a, torch.Tensor) else a for a in args)
+        if key not in self.keys:
+            self.keys.add(key)
+            if self.warm: self.recompiles += 1
+        return self.fn(*args)
+
+    @property
+    def stats(self):
+        return dict(compiled=len(self.keys), recompiles=self.recompiles)
+
 def inference_context():
     return nullcontext()
 
-def multinomial_sample_one_no_sync(probs_sort):
-    q = torch.empty_like(probs_sort).exponential_(1)
-    return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.int)
+def make_seeds(seed, n):
+    if seed is None: return [None] * n
+    if isinstance(seed, (list, tuple)): return list(seed) + [None] * (n - len(seed))
+    return [seed + i for i in range(n)]
 
-def logits_to_probs(logits, T=1.0, top_k=None):
-    logits = logits / max(T, 1e-5)
+def make_generators(seed, bs, device):
+    if seed is None: return None
+    return [None if s is None else torch.Generator(device=device).manual_seed(s) for s in make_seeds(seed, bs)]
 
-    if top_k is not None:
-        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-        pivot = v.select(-1, -1).unsqueeze(-1)
-        logits = torch.where(logits < pivot, -float("Inf"), logits)
+def exponential_noise(shape, device, generators, out=None):
+    q = torch.empty(shape, device=device) if out is None else out
+    if generators is None: return q.exponential_(1)
+    for row, g in zip(q, generators): row.exponential_(1, generator=g)
+    return q
 
+def multinomial_sample_one_no_sync(probs_sort, noise=None):
+    q = torch.empty_like(probs_sort).exponential_(1) if noise is None else noise
+    return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.int)
+
+def filter_logits(logits, top_k=None, top_p=None, min_p=None):
+    if top_k is not None or top_p is not None:
+        # top_p alone needs the exact nucleus, one sort of the vocabulary is cheaper than searching for it without one
+        v = torch.topk(logits, min(top_k, logits.size(-1))).values if top_k is not None else logits.sort(-1, descending=True).values
+        pivot = v[..., -1:]
+        if top_p is not None:
+            p = (v - v.logsumexp(-1, keepdim=True)).exp()
+            n = ((p.cumsum(-1) - p) < top_p).sum(-1, keepdim=True)
+            pivot = v.gather(-1, n - 1)
+        logits = logits.masked_fill(logits < pivot, -float("Inf"))
+    if min_p is not None:
+        logits = logits.masked_fill(logits < logits.amax(-1, keepdim=True) + math.log(min_p), -float("Inf"))
+    return logits
+
+def logits_to_probs(logits, T=1.0, top_k=None, top_p=None, min_p=None):
+    logits = logits / max(T, 1e-5)
+    logits = filter_logits(logits, top_k, top_p, min_p)
     probs = torch.nn.functional.softmax(logits, dim=-1)
     return probs
 
-def sample(logits, T=1.0, top_k=None):
-    probs = logits_to_probs(logits, T, top_k)
-    idx_next = multinomial_sample_one_no_sync(probs)
-    return idx_next
\ No newline at end of file
+def greedy(logits):
+    return torch.argmax(logits, dim=-1, keepdim=True).to(dtype=torch.int)
+
+def gumbel_sample(logits, T=1.0, top_k=None, noise=None, top_p=None, min_p=None):
+    # argmax(softmax(x/T) / E) == argmax(x/T - log(E)) for E ~ Exp(1), so the softmax is never materialized
+    logits = logits.float() / (T.clamp(min=1e-5) if isinstance(T, torch.Tensor) else max(T, 1e-5))
+    logits = filter_logits(logits, top_k, top_p, min_p)
+    if noise is None: noise = torch.empty_like(logits).exponential_(1)
+    return torch.argmax(logits - noise.log(), dim=-1, keepdim=True).to(dtype=torch.int)
+
+_compiled_sample = None
+
+def compile_sampler(enable=True):
+    global _compiled_sample
+    _compiled_sample = torch.compile(gumbel_sample, dynamic=True) if enable else None
+
+def sample(logits, T=1.0, top_k=None, noise=None, top_p=None, min_p=None):
+    if not isinstance(T, torch.Tensor) and T <= 0: return greedy(logits)
+    return (_compiled_sample or gumbel_sample)(logits, T, top_k, noise, top_p, min_p)
\ No newline at end of file
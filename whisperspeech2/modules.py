@@ -1,9 +1,10 @@
-__all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'init_transformer', 'sinusoids', 'MultiHeadAttention',
-           'ResidualAttentionBlock', 'BaseDecoder', 'EmbeddingProjector', 'FlexEmbeddings']
+__all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'init_transformer', 'sinusoids', 'PagedKVCache', 'MultiHeadAttention',
+           'ResidualAttentionBlock', 'BaseDecoder', 'EmbeddingProjector', 'FlexEmbeddings', 'Int8Linear', 'quantize_linears']
 
 import torch
 import numpy as np
 import math
+import threading
 
 from torch import Tensor, nn
 import torch.nn.functional as F
@@ -64,8 +65,69 @@ def rotate_half(x):
     )
 
 def rope_rotate(x, positions, cos, sin):
+    if positions.dim() == 2:
+        return x * cos[0,positions] + rotate_half(x) * sin[0,positions]
     return x * cos[:,positions] + rotate_half(x) * sin[:,positions]
 
+class PagedKVCache:
+    def __init__(self, n_blocks, block_size=64, device=None):
+        self.n_blocks = n_blocks
+        self.block_size = block_size
+        self.device = device
+        # block 0 is never handed out, unused table entries point at it
+        self._free = list(range(n_blocks - 1, 0, -1))
+        self._tables = {}
+        self._active = []
+        self._next_seq = 0
+        self._block_table = None
+        self._lock = threading.Lock()
+
+    @property
+    def free_blocks(self):
+        return len(self._free)
+
+    def blocks_for(self, length):
+        return -(-length // self.block_size)
+
+    def allocate(self, n=1):
+        with self._lock:
+            seqs = list(range(self._next_seq, self._next_seq + n))
+            self._next_seq += n
+            for s in seqs: self._tables[s] = []
+        return seqs
+
+    def reserve(self, seqs, length):
+        need = self.blocks_for(length)
+        with self._lock:
+            missing = sum(max(need - len(self._tables[s]), 0) for s in seqs)
+            if not missing: return
+            if missing > len(self._free):
+                raise RuntimeError(f"KV cache pool exhausted: {missing} blocks needed, {len(self._free)} free")
+            for s in seqs:
+                table = self._tables[s]
+                while len(table) < need: table.append(self._free.pop())
+            self._block_table = None
+
+    def release(self, seqs):
+        with self._lock:
+            for s in seqs:
+                self._free.extend(reversed(self._tables.pop(s, [])))
+            self._block_table = None
+
+    def activate(self, seqs):
+        with self._lock:
+            self._active = list(seqs)
+            self._block_table = None
+
+    @property
+    def block_table(self):
+        with self._lock:
+            if self._block_table is None:
+                tables = [self._tables.get(s, []) for s in self._active]
+                n = max([len(t) for t in tables] + [1])
+                self._block_table = torch.tensor([t + [0] * (n - len(t)) for t in tables], dtype=torch.long, device=self.device)
+            return self._block_table
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, n_state: int, n_head: int, qk_scale: float = 1, rope: bool = False, cross=False):
         super().__init__()
@@ -82,8 +144,11 @@ class MultiHeadAttention(nn.Module):
 
         self.register_buffer('k_cache', None)
         self.register_buffer('v_cache', None)
+        self.register_buffer('k_pages', None)
+        self.register_buffer('v_pages', None)
+        self.kv_pool = None
         self._cross_cache_ready = False
-        self._in_cuda_graph = False
+        self._cross_len = None
         
         self.rotary = None
         if rope:
@@ -96,6 +161,25 @@ class MultiHeadAttention(nn.Module):
         self.k_cache = torch.zeros(cache_shape, dtype=dtype, device=self.key.weight.device)
         self.v_cache = torch.zeros(cache_shape, dtype=dtype, device=self.value.weight.device)
 
+    def setup_paged_kv_cache(self, pool, max_seq_len, dtype=torch.float32):
+        pages_shape = (pool.n_blocks, self.n_head, pool.block_size, self.n_state//self.n_head)
+        self.k_cache, self.v_cache = None, None
+        self.k_pages = torch.zeros(pages_shape, dtype=dtype, device=self.key.weight.device)
+        self.v_pages = torch.zeros(pages_shape, dtype=dtype, device=self.value.weight.device)
+        self.kv_pool = pool
+        self.kv_len = max_seq_len
+
+    def paged_kv(self, k, v, positions):
+        table = self.kv_pool.block_table[:k.shape[0]]
+        if positions.dim() == 1: positions = positions.expand(k.shape[0], -1)
+        blocks = table.gather(1, positions // self.kv_pool.block_size)
+        offsets = positions % self.kv_pool.block_size
+        self.k_pages[blocks, :, offsets] = k.transpose(1, 2)
+        self.v_pages[blocks, :, offsets] = v.transpose(1, 2)
+        k = self.k_pages[table].transpose(1, 2).flatten(2, 3)[:,:,:self.kv_len]
+        v = self.v_pages[table].transpose(1, 2).flatten(2, 3)[:,:,:self.kv_len]
+        return k, v
+
     def merge_linears(self, layers, mults):
         bias = [x.bias for x in layers if x.bias is not None][0]
         din, dout = layers[0].weight.shape
@@ -123,6 +207,23 @@ class MultiHeadAttention(nn.Module):
             x = rope_rotate(x, x_positions * subsampling, *self.rotary(x))
         return x.permute(0, 2, 1, 3)
 
+    def prefill_cross_kv(self, kvx, kv_positions, rows=None):
+        if self.k_cache is None: return
+        if self.kv:
+            k,v = self.kv(kvx).split(self.odim, dim=-1)
+        else:
+            k,v = self.key(kvx) * self.sqrt_qk_scale, self.value(kvx)
+        k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
+        v = self.split_heads(v, kv_positions)
+        if rows is None:
+            self.k_cache[:k.shape[0],:,kv_positions] = k
+            self.v_cache[:v.shape[0],:,kv_positions] = v
+        else:
+            self.k_cache[rows[:,None],:,kv_positions] = k.transpose(1, 2)
+            self.v_cache[rows[:,None],:,kv_positions] = v.transpose(1, 2)
+        self._cross_len = kvx.shape[1]
+        self._cross_cache_ready = True
+
     def forward(
         self,
         qx,
@@ -136,9 +237,9 @@ class MultiHeadAttention(nn.Module):
             q,k,v = self.qkv(qx).split(self.odim, dim=-1)
         elif self.kv:
             q = self.q(qx)
-            if self.k_cache is not None and self.cross and self._cross_cache_ready and not self._in_cuda_graph:
+            if self.k_cache is not None and self.cross and self._cross_cache_ready:
                 q = self.split_heads(q, q_positions, rope=self.rotary, subsampling=self.query_subsampling)
-                k, v = self.k_cache[:q.shape[0]], self.v_cache[:q.shape[0]]
+                k, v = self.k_cache[:q.shape[0],:,:self._cross_len], self.v_cache[:q.shape[0],:,:self._cross_len]
                 if mask is not None:
                     mask = mask[q_positions,:k.shape[-2]]
                 wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal)
@@ -155,15 +256,21 @@ class MultiHeadAttention(nn.Module):
         if v is None: v = self.value(kvx)
         v = self.split_heads(v, kv_positions)
 
-        if self.k_cache is not None:
-            self.k_cache[:k.shape[0],:,kv_positions] = k
-            self.v_cache[:v.shape[0],:,kv_positions] = v
+        if self.kv_pool is not None:
+            k, v = self.paged_kv(k, v, kv_positions)
+        elif self.k_cache is not None:
+            if kv_positions.dim() == 2:
+                rows = torch.arange(k.shape[0], device=k.device)[:,None]
+                self.k_cache[rows,:,kv_positions] = k.transpose(1, 2)
+                self.v_cache[rows,:,kv_positions] = v.transpose(1, 2)
+            else:
+                self.k_cache[:k.shape[0],:,kv_positions] = k
+                self.v_cache[:v.shape[0],:,kv_positions] = v
             k, v = self.k_cache[:k.shape[0]], self.v_cache[:v.shape[0]]
-            if self.cross and kv_positions.numel() > 1:
-                self._cross_cache_ready = True
 
         if mask is not None:
             mask = mask[q_positions,:k.shape[-2]]
+            if q_positions.dim() == 2: mask = mask.unsqueeze(1)
 
         wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal)
 
@@ -187,10 +294,13 @@ class ResidualAttentionBlock(nn.Module):
         )
         self.mlp_ln = LayerNorm(n_state)
 
-    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None):
-        self.attn.setup_kv_cache(max_batch_size, max_seq_len)
+    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None, dtype=torch.float32, kv_pool=None):
+        if kv_pool is not None:
+            self.attn.setup_paged_kv_cache(kv_pool, max_seq_len, dtype=dtype)
+        else:
+            self.attn.setup_kv_cache(max_batch_size, max_seq_len, dtype=dtype)
         if self.cross_attn:
-            self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len)
+            self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len, dtype=dtype)
 
     def forward(
         self,
@@ -225,6 +335,10 @@ class BaseDecoder(nn.Module):
         mask = torch.empty(length, length).fill_(-torch.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
+    def prefill_cross_kv(self, xenc, xenc_positions, rows=None):
+        for l in self.layers:
+            l.cross_attn.prefill_cross_kv(xenc, xenc_positions, rows=rows)
+
     def forward(self, x, x_positions, xenc, xenc_positions):
         for i,l in enumerate(self.layers):
             x = l(x, x_positions, xenc, xenc_positions, causal=self.training, mask=self.mask if not self.training else None)
@@ -308,4 +422,67 @@ class FlexEmbeddings(nn.Module):
             return main_logits
 
         special_logits = (orig_embs @ self.special.weight.to(orig_embs.dtype).T).float()
-        return torch.cat([main_logits, special_logits], dim=-1)
\ No newline at end of file
+        return torch.cat([main_logits, special_logits], dim=-1)
+
+_int8mm_support = {}
+
+def _int8mm_supported(device, dtype):
+    # the fused int8 weight-only matmul only exists in recent PyTorch builds and not for every device/dtype pair
+    key = (torch.device(device).type, dtype)
+    if key not in _int8mm_support:
+        try:
+            x = torch.zeros((1, 32), device=device, dtype=dtype)
+            torch._weight_int8pack_mm(x, torch.zeros((8, 32), device=device, dtype=torch.int8), torch.ones(8, device=device, dtype=dtype))
+            _int8mm_support[key] = True
+        except (AttributeError, RuntimeError, NotImplementedError):
+            _int8mm_support[key] = False
+    return _int8mm_support[key]
+
+class Int8Linear(nn.Module):
+    def __init__(self, in_features, out_features, bias=True, device=None, dtype=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('weight', torch.zeros((out_features, in_features), dtype=torch.int8, device=device))
+        self.register_buffer('scales', torch.ones(out_features, dtype=dtype, device=device))
+        self.register_buffer('bias', torch.zeros(out_features, dtype=dtype, device=device) if bias else None)
+        self.use_int8mm = False
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear):
+        w = linear.weight.float()
+        scales = w.abs().amax(-1).clamp(min=1e-8) / 127
+        new = cls(linear.in_features, linear.out_features, linear.bias is not None, w.device, linear.weight.dtype)
+        new.weight[:] = (w / scales[:,None]).round().clamp(-128, 127).to(torch.int8)
+        new.scales[:] = scales
+        if linear.bias is not None: new.bias[:] = linear.bias
+        new.use_int8mm = _int8mm_supported(w.device, linear.weight.dtype)
+        return new
+
+    def forward(self, x):
+        if self.use_int8mm and x.dtype == self.scales.dtype:
+            # reads the int8 weight directly, no float copy of the weight per call
+            out = torch._weight_int8pack_mm(x.reshape(-1, self.in_features), self.weight, self.scales)
+            out = out.reshape(*x.shape[:-1], self.out_features)
+        else:
+            # under torch.compile inductor fuses the dequantization into the matmul
+            out = F.linear(x, self.weight.to(x.dtype)) * self.scales.to(x.dtype)
+        return out if self.bias is None else out + self.bias.to(x.dtype)
+
+def quantize_linears(model, mode='int8'):
+    # embeddings (and the projections around them) stay in float, the raw key/value/query layers are unused after convert_for_eval
+    names = [n for n, m in model.named_modules() if type(m) is nn.Linear
+             and not any('emb' in part for part in n.split('.')) and n.rsplit('.', 1)[-1] not in ('key', 'value')]
+    if mode == 'dynamic':
+        weight = model.get_submodule(names[0]).weight if names else None
+        if weight is None or weight.device.type != 'cpu' or weight.dtype != torch.float32:
+            print("Dynamic int8 quantization needs an fp32 model on the CPU. Falling back to weight-only int8.")
+            mode = 'int8'
+        else:
+            return torch.ao.quantization.quantize_dynamic(model, set(names), dtype=torch.qint8, inplace=True)
+    if mode != 'int8': raise ValueError(f"unknown quantization mode: {mode}")
+    for name in names:
+        parent, _, attr = name.rpartition('.')
+        setattr(model.get_submodule(parent), attr, Int8Linear.from_linear(model.get_submodule(name)))
+    return model
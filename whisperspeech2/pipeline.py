@@ -1,4 +1,4 @@
-__all__ = ['Pipeline']
+__all__ = ['Pipeline', 'QUALITY_TIERS']
 
 from os.path import expanduser
 import torch
@@ -6,8 +6,14 @@ import numpy as np
 from whisperspeech2.t2s_up_wds_mlang_enclm import TSARTransformer
 from whisperspeech2.s2a_delar_mup_wds_mlang import SADelARTransformer
 from whisperspeech2.a2wav import Vocoder
-from whisperspeech2 import inference, s2a_delar_mup_wds_mlang_cond
+from whisperspeech2 import inference, chunker, s2a_delar_mup_wds_mlang_cond
+from whisperspeech2.cache import TensorLRUCache, DiskCache, tensor_hash, model_fingerprint
+from whisperspeech2.audio_writer import AudioWriter, PCMBuffer
 import traceback
+import threading
+import itertools
+import queue
+from contextlib import nullcontext
 from pathlib import Path
 
 
@@ -141,22 +147,83 @@ SPEAKERS = {
 }
 
 
+# acoustic codebooks generated by the S2A model per tier, None means all of them
+QUALITY_TIERS = {'full': None, 'fast': 2}
+
+_DONE = object()
+
+class _StageError:
+    def __init__(self, exc):
+        self.exc = exc
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _drain(q, stop):
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE: return
+        if isinstance(item, _StageError): raise item.exc
+        if isinstance(item, torch.Tensor) and item.is_cuda: item.record_stream(torch.cuda.current_stream())
+        yield item
+
+def _run_stage(fn, source, sink, stop, use_stream):
+    stream = torch.cuda.Stream() if use_stream else None
+    try:
+        with torch.no_grad(), (torch.cuda.stream(stream) if stream else nullcontext()):
+            for item in source:
+                out = fn(item)
+                if stream is not None: stream.synchronize()
+                if not _put(sink, out, stop): return
+        _put(sink, _DONE, stop)
+    except Exception as e:
+        _put(sink, _StageError(e), stop)
+
+
 class Pipeline:
     default_speaker = SPEAKERS["default"]
 
-    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, use_cuda_graph=False, device=None):
+    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, use_cuda_graph=False, device=None, eos_patience=None, length_buckets=None, t2s_draft_ref=None, kv_cache_blocks=None, batch_buckets=None, cache_max_bytes=None,
+                 cache_dir=None, cache_dir_max_bytes=None, dtype=None, quantize=None, quality='full'):
         if device is None: device = inference.get_compute_device()
         self.device = device
         self.use_cuda_graph = use_cuda_graph
+        self.eos_patience = eos_patience
+        self.quality = quality
+        self.t2s_id, self.s2a_id = t2s_ref or 'default', s2a_ref or 'default'
+        self.stoks_cache = TensorLRUCache(cache_max_bytes) if cache_max_bytes else None
+        self.atoks_cache = TensorLRUCache(cache_max_bytes) if cache_max_bytes else None
+        if optimize and torch_compile: inference.compile_sampler()
+        # disk cache ids hash the checkpoint weights before optimize(), quantization turns most of them into buffers or packed params
+        fingerprint = model_fingerprint if cache_dir else lambda model: None
+        t2s_fp = s2a_fp = None
         args = dict(device = device)
         try:
             if t2s_ref:
                 args["ref"] = t2s_ref
             self.t2s = TSARTransformer.load_model(**args)
-            if optimize: self.t2s.optimize(torch_compile=torch_compile, use_cuda_graph=use_cuda_graph)
+            t2s_fp = fingerprint(self.t2s)
+            if optimize: self.t2s.optimize(dtype=dtype, torch_compile=torch_compile, use_cuda_graph=use_cuda_graph, length_buckets=length_buckets, kv_cache_blocks=kv_cache_blocks, batch_buckets=batch_buckets, quantize=quantize)
         except:
             print("Failed to load the T2S model:")
             print(traceback.format_exc())
+        self.t2s_draft = None
+        if t2s_draft_ref:
+            try:
+                self.t2s_draft = TSARTransformer.load_model(ref=t2s_draft_ref, device=device)
+                if optimize: self.t2s_draft.optimize(dtype=dtype, torch_compile=False, use_cuda_graph=False)
+            except:
+                print("Failed to load the T2S draft model:")
+                print(traceback.format_exc())
         args = dict(device = device)
         try:
             if s2a_ref:
@@ -170,13 +237,20 @@ class Pipeline:
             else:
                 cls = SADelARTransformer
             self.s2a = cls.load_model(**args)
-            if optimize: self.s2a.optimize(torch_compile=torch_compile, use_cuda_graph=use_cuda_graph)
+            s2a_fp = fingerprint(self.s2a)
+            if optimize: self.s2a.optimize(dtype=dtype, torch_compile=torch_compile, use_cuda_graph=use_cuda_graph, length_buckets=length_buckets, kv_cache_blocks=kv_cache_blocks, batch_buckets=batch_buckets, quantize=quantize)
         except:
             print("Failed to load the S2A model:")
             print(traceback.format_exc())
 
         self.vocoder = Vocoder(device=device)
         self.encoder = None
+        self.disk_cache = None
+        if cache_dir:
+            self.disk_cache = DiskCache(cache_dir, cache_dir_max_bytes)
+            self.t2s_id, self.s2a_id = [f"{fp}:{getattr(m, 'dtype', None)}:{quantize if optimize else None}"
+                                        for fp, m in [(t2s_fp, getattr(self, 't2s', None)), (s2a_fp, getattr(self, 's2a', None))]]
+            self.vocoder_id = model_fingerprint(self.vocoder.vocos)
 
     def reset_cuda_graphs(self):
         if hasattr(self, 't2s') and hasattr(self.t2s, 'reset_cuda_graph'):
@@ -184,6 +258,14 @@ class Pipeline:
         if hasattr(self, 's2a') and hasattr(self.s2a, 'reset_cuda_graph'):
             self.s2a.reset_cuda_graph()
 
+    def warmup(self, batch_sizes=None, top_ks=(None,), qualities=(None,)):
+        self.t2s.warmup(batch_sizes, top_ks)
+        self.s2a.warmup(batch_sizes, top_ks, n_quantizers=[self._n_quantizers(q) for q in qualities])
+
+    @property
+    def compile_stats(self):
+        return {name: m.compiled_step.stats for name, m in [('t2s', self.t2s), ('s2a', self.s2a)] if m.compiled_step is not None}
+
     def extract_spk_emb(self, fname):
         if self.encoder is None:
             device = self.device
@@ -211,20 +293,186 @@ class Pipeline:
 
         return spk_emb[0,0].to(self.device)
 
-    def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None):
+    def _resolve_speaker(self, speaker):
         if speaker is None: speaker = self.default_speaker
         elif isinstance(speaker, str) and speaker in SPEAKERS: speaker = SPEAKERS[speaker]
         elif isinstance(speaker, (str, Path)): speaker = self.extract_spk_emb(speaker)
+        return speaker
+
+    def _stoks_key(self, text, lang, cps, seed=None):
+        if self.stoks_cache is None and self.disk_cache is None: return None
+        return (self.t2s_id, text, lang if isinstance(lang, str) else tuple(lang), cps, seed)
+
+    def _n_quantizers(self, quality=None):
+        quality = quality or self.quality
+        n = QUALITY_TIERS.get(quality, quality)
+        if n is None or n == self.s2a.quantizers: return None
+        if n not in (2, 4, 8) or n > self.s2a.quantizers:
+            raise ValueError(f"unsupported quality: {quality!r} (expected one of {', '.join(QUALITY_TIERS)} or 2, 4, 8 quantizers)")
+        return n
+
+    def _atoks_key(self, stoks, speaker, seed=None, n_quantizers=None):
+        if self.atoks_cache is None and self.disk_cache is None: return None
+        return (self.s2a_id, tensor_hash(stoks), tensor_hash(speaker), self.eos_patience, seed, n_quantizers)
+
+    def _lookup(self, kind, key):
+        if key is None: return None
+        cache = getattr(self, kind + '_cache', None)
+        value = cache.get(key) if cache is not None else None
+        if value is None and self.disk_cache is not None:
+            value = self.disk_cache.get(kind, key, device=self.device)
+            if value is not None and cache is not None: cache.put(key, value)
+        return value
+
+    def _store(self, kind, key, value):
+        if key is None: return
+        cache = getattr(self, kind + '_cache', None)
+        if cache is not None: cache.put(key, value)
+        if self.disk_cache is not None: self.disk_cache.put(kind, key, value)
+
+    def _cached(self, kind, keys, fn):
+        out = [self._lookup(kind, k) for k in keys]
+        todo = [i for i, x in enumerate(out) if x is None]
+        if todo:
+            for i, x in zip(todo, fn(todo)):
+                out[i] = x
+                self._store(kind, keys[i], x)
+        return out
+
+    def _cached_stream(self, kind, key, chunks):
+        # the stream returns the same result as the non-streaming call once it ran to the end, an abandoned one stores nothing
+        value = yield from chunks
+        if value is not None: self._store(kind, key, value)
+
+    def _decode(self, atoks):
+        key = (self.vocoder_id, tensor_hash(atoks)) if self.disk_cache is not None else None
+        return self._cached('audio', [key], lambda _: [self.vocoder.decode(atoks)])[0]
+
+    def _decode_batch(self, atoks):
+        keys = [(self.vocoder_id, tensor_hash(a)) if self.disk_cache is not None else None for a in atoks]
+        return self._cached('audio', keys, lambda idx: self.vocoder.decode_batch([atoks[i] for i in idx]))
+
+    @property
+    def cache_stats(self):
+        return {name: c.stats for name, c in [('stoks', self.stoks_cache), ('atoks', self.atoks_cache), ('disk', self.disk_cache)] if c is not None}
+
+    def _generate_stoks(self, text, lang, cps, step_callback, seed=None, show_progress_bar=True):
+        def fn(_):
+            if self.t2s_draft is not None:
+                return [self.t2s.generate_speculative(text, self.t2s_draft, cps=cps, lang=lang, step=step_callback, seed=seed)[0]]
+            return [self.t2s.generate(text, cps=cps, lang=lang, step=step_callback, show_progress_bar=show_progress_bar, seed=seed)[0]]
+        return self._cached('stoks', [self._stoks_key(text, lang, cps, seed)], fn)[0]
+
+    def _generate_atoks(self, stoks, speaker, step_callback=None, show_progress_bar=True, seed=None, n_quantizers=None):
+        fn = lambda _: [self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback, show_progress_bar=show_progress_bar, eos_patience=self.eos_patience, seed=seed,
+                                          n_quantizers=n_quantizers)]
+        return self._cached('atoks', [self._atoks_key(stoks, speaker, seed, n_quantizers)], fn)[0]
+
+    def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None, seed=None, quality=None):
+        n_quantizers = self._n_quantizers(quality)
+        speaker = self._resolve_speaker(speaker)
+        text = text.replace("\n", " ")
+        stoks = self._generate_stoks(text, lang, cps, step_callback, seed)
+        return self._generate_atoks(stoks, speaker, step_callback, seed=seed, n_quantizers=n_quantizers)
+
+    def generate_atoks_batch(self, texts, speaker=None, lang='en', cps=15, step_callback=None, seed=None, quality=None):
+        n_quantizers = self._n_quantizers(quality)
+        if isinstance(speaker, (list, tuple)):
+            speakers = torch.stack([self._resolve_speaker(s).to(self.device) for s in speaker])
+        else:
+            speakers = self._resolve_speaker(speaker).to(self.device).unsqueeze(0)
+        texts = [text.replace("\n", " ") for text in texts]
+        if not isinstance(cps, (list, tuple)): cps = [cps] * len(texts)
+        if not isinstance(lang, (list, tuple)): lang = [lang] * len(texts)
+        seeds = inference.make_seeds(seed, len(texts))
+        stoks = self._cached('stoks', [self._stoks_key(*x) for x in zip(texts, lang, cps, seeds)],
+                             lambda idx: self.t2s.generate_batch([texts[i] for i in idx], cps=[cps[i] for i in idx], lang=[lang[i] for i in idx], step=step_callback,
+                                                                 seed=None if seed is None else [seeds[i] for i in idx]))
+        spk = lambda i: speakers[i if speakers.shape[0] > 1 else 0]
+        return self._cached('atoks', [self._atoks_key(s, spk(i), seeds[i], n_quantizers) for i, s in enumerate(stoks)],
+                            lambda idx: self.s2a.generate_batch([stoks[i] for i in idx], torch.stack([spk(i) for i in idx]), step=step_callback, eos_patience=self.eos_patience,
+                                                                seed=None if seed is None else [seeds[i] for i in idx], n_quantizers=n_quantizers))
+
+    def generate(self, text, speaker=None, lang='en', cps=15, step_callback=None, seed=None, quality=None):
+        return self._decode(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=step_callback, seed=seed, quality=quality))
+
+    def generate_stream(self, text, speaker=None, lang='en', cps=15, chunk_frames=50, context_frames=None, lookahead_frames=None, crossfade=256, step_callback=None, seed=None, quality=None):
+        n_quantizers = self._n_quantizers(quality)
+        speaker = self._resolve_speaker(speaker)
         text = text.replace("\n", " ")
-        stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback)[0]
-        atoks = self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback)
-        return atoks
+        stoks = self._generate_stoks(text, lang, cps, step_callback, seed)
+        key = self._atoks_key(stoks, speaker, seed, n_quantizers)
+        atoks = self._lookup('atoks', key)
+        if atoks is not None:
+            chunks = atoks.split(chunk_frames, dim=-1)
+        else:
+            chunks = self._cached_stream('atoks', key, self.s2a.generate_stream(stoks, speaker.unsqueeze(0), chunk_size=chunk_frames, step=step_callback,
+                                                                               eos_patience=self.eos_patience, seed=seed, n_quantizers=n_quantizers))
+        yield from self.vocoder.decode_stream(chunks, context_frames, lookahead_frames, crossfade)
+
+    def generate_pipelined(self, texts, speaker=None, lang='en', cps=15, max_queue=2, step_callback=None, seed=None, quality=None):
+        if isinstance(texts, str): texts = [texts]
+        n_quantizers = self._n_quantizers(quality)
+        speaker = self._resolve_speaker(speaker)
+        use_stream = torch.cuda.is_available() and str(self.device).startswith('cuda')
+        stop = threading.Event()
+        stoks_q, atoks_q, audio_q = [queue.Queue(maxsize=max_queue) for _ in range(3)]
+        # text i gets seed + i like in generate_long, both stages see the texts in order so each counts them on its own
+        t2s_seeds, s2a_seeds = [itertools.count(seed) if seed is not None else itertools.repeat(None) for _ in range(2)]
+        stages = [
+            (lambda text: self._generate_stoks(text.replace("\n", " "), lang, cps, step_callback, next(t2s_seeds), show_progress_bar=False), iter(texts), stoks_q),
+            (lambda stoks: self._generate_atoks(stoks, speaker, step_callback, show_progress_bar=False, seed=next(s2a_seeds), n_quantizers=n_quantizers),
+             _drain(stoks_q, stop), atoks_q),
+            (self._decode, _drain(atoks_q, stop), audio_q),
+        ]
+        workers = [threading.Thread(target=_run_stage, args=(fn, source, sink, stop, use_stream), daemon=True)
+                   for fn, source, sink in stages]
+        for w in workers: w.start()
+        try:
+            yield from _drain(audio_q, stop)
+        finally:
+            stop.set()
+            for w in workers: w.join()
+
+    def split_text(self, text, cps=15):
+        max_bytes = self.t2s.ttoks_len - 2
+        max_chars = int((self.t2s.stoks_len - 2) / 25 * cps)
+        return [chunker.chunk_text(p, max_bytes, max_chars) for p in chunker.split_paragraphs(text)]
+
+    def generate_long(self, text, speaker=None, lang='en', cps=15, batch_size=8, pause=0.2, paragraph_pause=0.6, sample_rate=24000, seed=None, quality=None):
+        paragraphs = self.split_text(text, cps=cps)
+        chunks = [c for p in paragraphs for c in p]
+        audio = []
+        for i in range(0, len(chunks), batch_size):
+            audio += self.generate_batch(chunks[i:i+batch_size], speaker, lang=lang, cps=cps, seed=None if seed is None else seed + i, quality=quality)
+        audio, out = iter(audio), []
+        for pi, p in enumerate(paragraphs):
+            for ci in range(len(p)):
+                a = next(audio)
+                out.append(a)
+                gap = pause if ci < len(p) - 1 else paragraph_pause if pi < len(paragraphs) - 1 else 0
+                if gap: out.append(a.new_zeros(a.shape[:-1] + (int(gap * sample_rate),)))
+        return torch.cat(out, dim=-1) if out else torch.zeros(0)
+
+    def generate_batch(self, texts, speaker=None, lang='en', cps=15, step_callback=None, seed=None, quality=None):
+        return self._decode_batch(self.generate_atoks_batch(texts, speaker, lang=lang, cps=cps, step_callback=step_callback, seed=seed, quality=quality))
+
+    def generate_to_file(self, fname, text, speaker=None, lang='en', cps=15, step_callback=None, seed=None, format=None, sample_rate=24000, quality=None):
+        self.vocoder.decode_to_file(fname, self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None, seed=seed, quality=quality), format=format, sample_rate=sample_rate)
+
+    def generate_pcm(self, text, speaker=None, lang='en', cps=15, out=None, dtype='int16', **kwargs):
+        out = out or PCMBuffer(dtype=dtype)
+        return out.fill(self.generate(text, speaker, lang=lang, cps=cps, **kwargs))
 
-    def generate(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        return self.vocoder.decode(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=step_callback))
+    def generate_stream_pcm(self, text, speaker=None, lang='en', cps=15, out=None, dtype='int16', **kwargs):
+        out = out or PCMBuffer(dtype=dtype)
+        for audio in self.generate_stream(text, speaker, lang=lang, cps=cps, **kwargs):
+            yield out.fill(audio)
 
-    def generate_to_file(self, fname, text, speaker=None, lang='en', cps=15, step_callback=None):
-        self.vocoder.decode_to_file(fname, self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
+    def generate_stream_to_file(self, fname, text, speaker=None, lang='en', cps=15, format=None, sample_rate=24000, bitrate=None, **kwargs):
+        with AudioWriter(fname, format, sample_rate=sample_rate, input_rate=24000, bitrate=bitrate) as writer:
+            for audio in self.generate_stream(text, speaker, lang=lang, cps=cps, **kwargs):
+                writer.write(audio)
 
-    def generate_to_notebook(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        self.vocoder.decode_to_notebook(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
+    def generate_to_notebook(self, text, speaker=None, lang='en', cps=15, step_callback=None, quality=None):
+        self.vocoder.decode_to_notebook(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None, quality=quality))
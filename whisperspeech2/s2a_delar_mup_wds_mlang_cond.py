@@ -5,7 +5,10 @@ import io
 import time
 import math
 import random
+import itertools
 import dataclasses
+import threading
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
@@ -144,6 +147,7 @@ class DelSumEmbedding(nn.Module):
         if atoks_width is None: atoks_width = width
         self.width = width
         self.quantizers = quantizers
+        self.codes = codes
 
         emb = None
         embs = []
@@ -160,8 +164,11 @@ class DelSumEmbedding(nn.Module):
         newn = min(n, self.length)
 
         embs = torch.zeros((b,newn,self.width), dtype=xenc.dtype, device=xenc.device)
-        for i in range(self.quantizers):
+        for i in range(toks.shape[1]):
             embs[:, :] += self.embeddings[i](toks[:,i,:])
+        # codebooks dropped by a quality tier read as the start token they hold before their delay, like in training
+        for i in range(toks.shape[1], self.quantizers):
+            embs[:, :] += self.embeddings[i](toks.new_full((b,n), self.codes+1))
         
         x = embs.to(xenc.dtype)
         return x
@@ -176,10 +183,18 @@ class DelSumHead(nn.Module):
             nn.GELU(),
         )
 
-    def forward(self, x, embeddings=None):
+    def forward(self, x, embeddings=None, quantizers=None):
         b, newn, _ = x.shape
-        split = self.splitter(x).view(b,newn,self.quantizers,self.width)
-        logits = torch.stack([embeddings[q].unembed(split[:,:,q]) for q in range(self.quantizers)], dim=1)
+        quantizers = quantizers or self.quantizers
+        rows = quantizers * self.width
+        linear = self.splitter[0]
+        if quantizers < self.quantizers and type(linear) is nn.Linear:
+            # the splitter outputs are grouped by quantizer, skip the rows of the ones we do not sample
+            split = self.splitter[1](F.linear(x, linear.weight[:rows], linear.bias[:rows]))
+        else:
+            split = self.splitter(x)[..., :rows]
+        split = split.reshape(b,newn,quantizers,self.width)
+        logits = torch.stack([embeddings[q].unembed(split[:,:,q]) for q in range(quantizers)], dim=1)
         return logits
         
 def rand(start, end):
@@ -353,9 +368,17 @@ class SADelARTransformer(nn.Module):
         self.static_xenc_positions = None
         self.static_T = None
         self.static_top_k = None
+        self.static_top_p = None
+        self.static_min_p = None
         self.static_output = None
         self.static_exponential_noise = None
         self.use_cuda_graph = False
+        self.length_buckets = None
+        self.kv_pool = None
+        self._kv_seqs = []
+        self._generation_lock = threading.Lock()
+        self.compiled_step = None
+        self.batch_buckets = None
         
         self.apply(self.init_transformer)
 
@@ -417,7 +440,7 @@ class SADelARTransformer(nn.Module):
         bs = Stoks.shape[0]
 
         semb = self.embed_stoks(Stoks)
-        if self.positional_embeddings is not None: semb = semb + self.positional_embeddings
+        if self.positional_embeddings is not None: semb = semb + self.positional_embeddings[:semb.shape[1]]
         positions = torch.arange(0, semb.shape[1], device=semb.device)
         xenc = self._encoder(semb, positions)
         if self.training and self.tunables.causal_encoder:
@@ -443,7 +466,7 @@ class SADelARTransformer(nn.Module):
         embs = self.embds(Atoks, xenc)
         if atoks_positions is None: atoks_positions = torch.arange(0, embs.shape[1], device=embs.device)
         x = self.decoder(embs, atoks_positions, xenc, xenc_positions)
-        logits = self.head(x, embeddings=self.embds.embeddings)
+        logits = self.head(x, embeddings=self.embds.embeddings, quantizers=Atoks.shape[1])
         logits *= self.tunables.output_mult / (self.width / self.base_width)
 
         if noloss:
@@ -516,45 +539,48 @@ class SADelARTransformer(nn.Module):
             for bn,b in m.named_buffers(recurse=False):
                 setattr(m,bn,b.to(dtype))
 
-    def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=False, use_cuda_graph=False):
+    def optimize(self, max_batch_size=1, dtype=None, torch_compile=False, use_cuda_graph=False, length_buckets=None,
+                 kv_cache_blocks=None, kv_block_size=64, batch_buckets=None, quantize=None):
         for emb in self.embds.embeddings:
             emb.convert_for_eval()
         for l in self.encoder:
             l.attn.convert_for_eval()
+        self.kv_pool = PagedKVCache(kv_cache_blocks, kv_block_size, self.device) if kv_cache_blocks else None
         for l in self.decoder.layers:
             l.attn.convert_for_eval()
             l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.ctx_n, self.stoks_len)
-        self.switch_dtypes(dtype)
+            l.setup_kv_cache(max_batch_size, self.ctx_n, self.stoks_len, kv_pool=self.kv_pool)
+        if quantize == 'dynamic' and self.device.type == 'cpu': dtype = torch.float32
+        self.switch_dtypes(dtype or inference.get_inference_dtype(self.device))
+        if quantize: quantize_linears(self, quantize)
+        if use_cuda_graph and self.kv_pool is not None:
+            print("CUDA graphs are not supported with the paged KV cache. Falling back to standard inference.")
+            use_cuda_graph = False
         self.use_cuda_graph = use_cuda_graph
-        if torch_compile:
-            self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
+        self.length_buckets = length_buckets
+        self.batch_buckets = batch_buckets
+        if torch_compile and self.kv_pool is not None:
+            print("torch.compile is not supported with the paged KV cache. Falling back to standard inference.")
+            torch_compile = False
+        self.compiled_step = inference.CompiledStep(self.generate_one, self.device) if torch_compile else None
 
     def _sample_with_static_noise(self, logits, T, top_k):
-        T_val = T if isinstance(T, torch.Tensor) else torch.tensor(T, device=logits.device)
-        T_clamped = torch.clamp(T_val, min=1e-5)
-        logits = logits / T_clamped
-        
-        if top_k is not None:
-            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-            pivot = v.select(-1, -1).unsqueeze(-1)
-            logits = torch.where(logits < pivot, -float("Inf"), logits)
-        
-        probs = torch.nn.functional.softmax(logits, dim=-1)
-        self.static_exponential_noise.exponential_(1)
-        return torch.argmax(probs / self.static_exponential_noise, dim=-1, keepdim=True).to(dtype=torch.int)
+        return inference.gumbel_sample(logits, T, top_k, self.static_exponential_noise, self.static_top_p, self.static_min_p)
 
-    def _init_cuda_graph_buffers(self, bs, xenc, xenc_positions, T, top_k):
+    def _init_cuda_graph_buffers(self, bs, xenc, xenc_positions, T, top_k, top_p=None, min_p=None, quantizers=None):
         dev = self.device
-        self.static_toks = torch.zeros((bs, self.quantizers, 1), dtype=torch.long, device=dev)
+        quantizers = quantizers or self.quantizers
+        self.static_toks = torch.zeros((bs, quantizers, 1), dtype=torch.long, device=dev)
         self.static_positions = torch.zeros((1,), dtype=torch.long, device=dev)
         self.static_xenc = xenc.clone()
         self.static_xenc_positions = xenc_positions.clone()
         self.static_T = T.clone() if isinstance(T, torch.Tensor) else torch.tensor(T, device=dev)
         self.static_top_k = top_k
+        self.static_top_p = top_p
+        self.static_min_p = min_p
         
-        logits_shape = (bs, self.quantizers, self.codes + 2)
-        self.static_exponential_noise = torch.empty(logits_shape, device=dev, dtype=torch.float32)
+        logits_shape = (bs, quantizers, self.codes + 2)
+        self.static_exponential_noise = torch.empty(logits_shape, device=dev, dtype=torch.float32).exponential_(1)
 
     def _generate_one_for_graph(self, toks, positions, xenc, xenc_positions, T, top_k):
         logits = self(None, toks, None, None, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
@@ -588,15 +614,63 @@ class SADelARTransformer(nn.Module):
             )
         self.cuda_graph_warmup_done = True
 
-    def _cuda_graph_generate_one(self, toks, positions):
+    def _cuda_graph_generate_one(self, toks, positions, generators=None):
         self.static_toks.copy_(toks)
         self.static_positions.copy_(positions)
+        inference.exponential_noise(None, None, generators, out=self.static_exponential_noise)
         self.cuda_graph.replay()
         return self.static_output.clone()
 
-    def _update_static_buffers(self, xenc, xenc_positions):
+    def _update_static_buffers(self, xenc, xenc_positions, T):
         self.static_xenc.copy_(xenc)
         self.static_xenc_positions.copy_(xenc_positions)
+        self.static_T.copy_(T)
+
+    def _prepare_cuda_graph(self, bs, xenc, xenc_positions, langs, T, top_k, top_p=None, min_p=None, quantizers=None):
+        if not self.use_cuda_graph: return
+        quantizers = quantizers or self.quantizers
+        if self.cuda_graph_warmup_done and (self.static_xenc.shape != xenc.shape or self.static_toks.shape[1] != quantizers
+                                            or (self.static_top_k, self.static_top_p, self.static_min_p) != (top_k, top_p, min_p)):
+            self.reset_cuda_graph()
+        if not self.cuda_graph_warmup_done:
+            self._init_cuda_graph_buffers(bs, xenc, xenc_positions, T, top_k, top_p, min_p, quantizers)
+            self._capture_cuda_graph(langs)
+        else:
+            self._update_static_buffers(xenc, xenc_positions, T)
+
+    def _ensure_kv_cache(self, bs):
+        for l in self.decoder.layers:
+            if l.cross_attn.k_cache is not None and l.cross_attn.k_cache.shape[0] < bs:
+                if self.kv_pool is None:
+                    l.setup_kv_cache(bs, self.ctx_n, self.stoks_len, dtype=self.dtype)
+                else:
+                    l.cross_attn.setup_kv_cache(bs, self.stoks_len, dtype=self.dtype)
+                self.reset_cuda_graph()
+
+    def _kv_acquire(self, bs):
+        if self.kv_pool is None: return
+        self._kv_release()
+        self._kv_seqs = self.kv_pool.allocate(bs)
+        self.kv_pool.activate(self._kv_seqs)
+
+    def _kv_reserve(self, length):
+        if self.kv_pool is not None: self.kv_pool.reserve(self._kv_seqs, length)
+
+    def _kv_release(self):
+        if self.kv_pool is None or not self._kv_seqs: return
+        self.kv_pool.release(self._kv_seqs)
+        self._kv_seqs = []
+
+    @contextmanager
+    def _generating(self):
+        # the KV caches, CUDA graph buffers and pool sequences are model state, so a model runs one generation at a time
+        if not self._generation_lock.acquire(blocking=False):
+            raise RuntimeError(f"{type(self).__name__} is already generating, use a separate model instance for each concurrent caller")
+        try:
+            yield
+        finally:
+            self._kv_release()
+            self._generation_lock.release()
 
     def reset_cuda_graph(self):
         self.cuda_graph = None
@@ -608,6 +682,8 @@ class SADelARTransformer(nn.Module):
         self.static_xenc_positions = None
         self.static_T = None
         self.static_top_k = None
+        self.static_top_p = None
+        self.static_min_p = None
         self.static_output = None
         self.static_exponential_noise = None
 
@@ -619,58 +695,198 @@ class SADelARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k):
+    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k, noise=None, top_p=None, min_p=None):
         probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
         probs = probs[:,:,-1]
-        return inference.sample(probs, T, top_k)
+        return inference.sample(probs, T, top_k, noise, top_p, min_p)
 
-    def generate_next(self, *args, **kwargs):
-        return self.generate_one(*args, **kwargs)
+    def generate_next(self, toks, positions, langs, xenc, xenc_positions, T, top_k, noise=None, top_p=None, min_p=None):
+        if self.compiled_step is None:
+            return self.generate_one(toks, positions, langs, xenc, xenc_positions, T, top_k, noise, top_p, min_p)
+        # unseeded steps get their noise drawn here too, so the compiled step is not specialized on noise being present
+        if noise is None: noise = inference.exponential_noise((toks.shape[0], toks.shape[1], self.codes + 2), self.device, None)
+        return self.compiled_step(toks, positions, langs, xenc, xenc_positions, T, top_k, noise, top_p, min_p)
+
+    def _noise(self, bs, generators, quantizers=None):
+        if generators is None: return None
+        return inference.exponential_noise((bs, quantizers or self.quantizers, self.codes + 2), self.device, generators)
+
+    def _n_quantizers(self, n_quantizers):
+        if n_quantizers is None: return self.quantizers
+        if not 0 < n_quantizers <= self.quantizers:
+            raise ValueError(f"n_quantizers must be between 1 and {self.quantizers}, got {n_quantizers}")
+        return n_quantizers
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes=None, top_ks=(None,), T=0.7, n_quantizers=(None,)):
+        with self._generating():
+            dev = self.device
+            enc_lens = sorted({min(b, self.stoks_len) for b in self.length_buckets or []} | {self.stoks_len})
+            for bs, top_k, enc_len, q in itertools.product(batch_sizes or self.batch_buckets or [1], top_ks, enc_lens, n_quantizers):
+                self._ensure_kv_cache(bs)
+                stoks = torch.full((bs, enc_len), self.stoks_codes-1, dtype=torch.long, device=dev)
+                xenc, xenc_positions, _ = self.run_encoder(stoks, [{}] * bs)
+                self.decoder.prefill_cross_kv(xenc, xenc_positions)
+                toks = torch.full((bs, self._n_quantizers(q), 1), self.codes+1, dtype=torch.long, device=dev)
+                self._kv_acquire(bs)
+                self._kv_reserve(3)
+                for i in range(3):
+                    self.generate_next(toks, torch.tensor([i], device=dev), None, xenc, xenc_positions, torch.tensor(T, device=dev), top_k)
+            if self.compiled_step is not None: self.compiled_step.warm = True
     
     @torch.no_grad()
-    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False):
-        dev = self.device
+    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, top_p=None, min_p=None, show_progress_bar=True, step=None, subsample_enc=False, eos_patience=None, seed=None, n_quantizers=None):
+        if eos_patience: stoks = self._trim_stoks(stoks)
         N = N or len(stoks) * 3
-        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
-        speakers = speakers.to(device=dev, dtype=self.dtype)
-        toks = torch.full((bs,self.quantizers,self.ctx_n), self.codes+1, dtype=torch.long, device=dev)
-        T = torch.tensor(T, device=dev)
-
-        start = 0
-        if atoks_prompt is not None:
-            start = atoks_prompt.shape[-1]
-            for i in range(self.quantizers):
-                toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
-        start += 1
+        for toks, _, n in self._generate_steps(stoks, speakers, langs, atoks_prompt, N, bs, T, top_k, show_progress_bar, step, eos_patience, seed, top_p, min_p, n_quantizers): pass
+        return self._undelay(toks, 0, n)
 
-        stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
-        xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
-        toks_positions = torch.arange(N, device=dev)
+    @torch.no_grad()
+    def generate_stream(self, stoks, speakers, langs=None, chunk_size=50, N=None, T=0.7, top_k=None, top_p=None, min_p=None, show_progress_bar=False, step=None, eos_patience=None, seed=None, n_quantizers=None):
+        if eos_patience: stoks = self._trim_stoks(stoks)
+        N = N or len(stoks) * 3
+        emitted = 0
+        for toks, i, n in self._generate_steps(stoks, speakers, langs, None, N, 1, T, top_k, show_progress_bar, step, eos_patience, seed, top_p, min_p, n_quantizers):
+            # frame k is complete once its last quantizer is sampled at k+q, and an EOS found later can still cut n down to i+1-eos_patience
+            ready = min(i + 1 - max(toks.shape[1], eos_patience or 0), n)
+            if ready - emitted >= chunk_size:
+                yield self._undelay(toks, emitted, ready)
+                emitted = ready
+        if emitted < n:
+            yield self._undelay(toks, emitted, n)
+        return self._undelay(toks, 0, n)
+
+    def _stoks_bucket(self, n, seed=None):
+        # the encoder output depends on the padded length, seeded calls always pad to the full context
+        # so that a request gives the same tokens alone and inside a batch
+        if seed is not None: return self.stoks_len
+        return inference.bucket_length(n + 2, self.length_buckets, self.stoks_len)
+
+    def _trim_stoks(self, stoks):
+        content = (stoks != self.stoks_codes-1).nonzero()
+        return stoks[:max(content[-1].item() + 1 if len(content) else 0, 1)]
+
+    def _generate_steps(self, stoks, speakers, langs, atoks_prompt, N, bs, T, top_k, show_progress_bar, step, eos_patience=None, seed=None, top_p=None, min_p=None, n_quantizers=None):
+        with self._generating():
+            dev = self.device
+            q = self._n_quantizers(n_quantizers)
+            n = N - 4
+            stopped = False
+            stoks = F.pad(stoks.to(dev), (1, self._stoks_bucket(len(stoks), seed) - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
+            speakers = speakers.to(device=dev, dtype=self.dtype)
+            self._ensure_kv_cache(bs)
+            toks = torch.full((bs,q,self.ctx_n), self.codes+1, dtype=torch.long, device=dev)
+            T = torch.tensor(T, device=dev)
+
+            start = 0
+            if atoks_prompt is not None:
+                start = atoks_prompt.shape[-1]
+                for i in range(q):
+                    toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
+            start += 1
+
+            stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
+            xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
+            toks_positions = torch.arange(self.ctx_n, device=dev)
         
-        if self.use_cuda_graph and not self.cuda_graph_warmup_done:
-            self._init_cuda_graph_buffers(bs, xenc, xenc_positions, T, top_k)
-            self._capture_cuda_graph(langs)
-        elif self.use_cuda_graph and self.cuda_graph_warmup_done:
-            self._update_static_buffers(xenc, xenc_positions)
+            self.decoder.prefill_cross_kv(xenc, xenc_positions)
+            self._prepare_cuda_graph(bs, xenc, xenc_positions, langs, T, top_k, top_p, min_p, q)
         
-        initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k)
-        toks[:,:start,start:start+1] = initial[:,:start]
-        start += 1
-
-        it = range(start,min(N,self.ctx_n-1))
-        if show_progress_bar: it = progress_bar(it)
-
-        for i in it:
-            if self.use_cuda_graph and self.cuda_graph_warmup_done:
-                toks[:,:i,i:i+1] = self._cuda_graph_generate_one(toks[:,:,i-1:i], toks_positions[i-1:i])[:,:i]
-            else:
-                toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k)[:,:i]
-
-            if step is not None: step()
-        toks = toks[:,:,1:N]
-        for j in range(self.quantizers):
-            toks[:, j] = torch.roll(toks[:, j], -j)
-        return toks[:,:,:N-4]
+            gens = inference.make_generators(seed, bs, dev)
+            self._kv_acquire(bs)
+            self._kv_reserve(start)
+            initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k, self._noise(bs, gens, q), top_p, min_p)
+            toks[:,:start,start:start+1] = initial[:,:start]
+            yield toks, start, n
+            start += 1
+
+            # the last frame of quantizer q-1 sits at position n+q-1, with fewer quantizers the trailing delay steps are skipped
+            it = range(start,min(n+q,self.ctx_n-1))
+            if show_progress_bar: it = progress_bar(it)
+
+            for i in it:
+                self._kv_reserve(i)
+                if self.use_cuda_graph and self.cuda_graph_warmup_done:
+                    toks[:,:i,i:i+1] = self._cuda_graph_generate_one(toks[:,:,i-1:i], toks_positions[i-1:i], gens)[:,:i]
+                else:
+                    toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k, self._noise(bs, gens, q), top_p, min_p)[:,:i]
+
+                if step is not None: step()
+                if eos_patience and not stopped and i >= eos_patience and (toks[:,0,i-eos_patience+1:i+1] == self.codes).all():
+                    n, stopped = min(n, i - eos_patience), True
+                yield toks, i, n
+                if stopped and i >= n + q - 1: break
+
+    @torch.no_grad()
+    def generate_batch(self, stoks, speakers, langs=None, T=0.7, top_k=None, top_p=None, min_p=None, show_progress_bar=True, step=None, eos_patience=None, seed=None, n_quantizers=None):
+        with self._generating():
+            dev = self.device
+            q = self._n_quantizers(n_quantizers)
+            n_real = len(stoks)
+            bs = inference.batch_bucket(n_real, self.batch_buckets)
+            stoks = list(stoks) + [stoks[-1]] * (bs - n_real)
+            if isinstance(speakers, (list, tuple)): speakers = list(speakers) + [speakers[-1]] * (bs - n_real)
+            if eos_patience: stoks = [self._trim_stoks(s) for s in stoks]
+            lengths = [len(s) * 3 for s in stoks]
+            N = max(lengths)
+            stoks_len = self._stoks_bucket(max(len(s) for s in stoks), seed)
+            stoks = torch.stack([F.pad(s.to(dev), (1, stoks_len - len(s) - 1), value=self.stoks_codes-1) for s in stoks])
+            if isinstance(speakers, (list, tuple)): speakers = torch.stack([s.to(dev) for s in speakers])
+            speakers = speakers.to(device=dev, dtype=self.dtype)
+            if bs > n_real and speakers.shape[0] == n_real > 1: speakers = torch.cat([speakers, speakers[-1:].expand(bs - n_real, -1)])
+            if speakers.shape[0] != bs: speakers = speakers.expand(bs, -1)
+            T = torch.tensor(T, device=dev)
+
+            self._ensure_kv_cache(bs)
+            toks = torch.full((bs,q,self.ctx_n), self.codes+1, dtype=torch.long, device=dev)
+            xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
+            toks_positions = torch.arange(self.ctx_n, device=dev)
+
+            self.decoder.prefill_cross_kv(xenc, xenc_positions)
+            self._prepare_cuda_graph(bs, xenc, xenc_positions, langs, T, top_k, top_p, min_p, q)
+
+            gens = inference.make_generators(seed, bs, dev)
+            self._kv_acquire(bs)
+            self._kv_reserve(1)
+            toks[:,:1,1:2] = self.generate_one(toks[:,:,:1], toks_positions[:1], langs, xenc, xenc_positions, T, top_k, self._noise(bs, gens, q), top_p, min_p)[:,:1]
+
+            ends = torch.tensor([max(n-4, 0) for n in lengths], device=dev)
+            last = torch.tensor([min(max(n-4, 0)+q,self.ctx_n-1)-1 for n in lengths], device=dev)
+            found = torch.zeros(bs, dtype=torch.bool, device=dev)
+            it = range(2,min(max(N-4, 0)+q,self.ctx_n-1))
+            if show_progress_bar: it = progress_bar(it)
+
+            for i in it:
+                self._kv_reserve(i)
+                if self.use_cuda_graph and self.cuda_graph_warmup_done:
+                    toks[:,:i,i:i+1] = self._cuda_graph_generate_one(toks[:,:,i-1:i], toks_positions[i-1:i], gens)[:,:i]
+                else:
+                    toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k, self._noise(bs, gens, q), top_p, min_p)[:,:i]
+
+                if step is not None: step()
+                if eos_patience and i >= eos_patience:
+                    hit = (toks[:,0,i-eos_patience+1:i+1] == self.codes).all(-1) & ~found
+                    ends[hit] = ends[hit].clamp(max=i-eos_patience)
+                    found |= hit
+                    if (i >= torch.where(found, ends + q - 1, last)).all(): break
+            return [self._undelay(toks[j], 0, n) for j,n in enumerate(ends.tolist()[:n_real])]
+
+    @torch.no_grad()
+    def prefill_slot(self, slot, stoks, speaker):
+        dev = self.device
+        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
+        speaker = speaker.to(device=dev, dtype=self.dtype)
+        xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = speaker, snr=60, c50=60)])
+        self.decoder.prefill_cross_kv(xenc, xenc_positions, rows=torch.tensor([slot], device=dev))
+        return xenc[0]
+
+    @torch.no_grad()
+    def decode_slots(self, toks, positions, xenc, xenc_positions, T, top_k, noise=None, top_p=None, min_p=None):
+        logits = self(None, toks, None, None, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
+        return inference.sample(logits[:,:,-1], T, top_k, noise, top_p, min_p)
+
+    def _undelay(self, toks, start, end):
+        return torch.stack([toks[...,q,1+q+start:1+q+end] for q in range(toks.shape[-2])], dim=-2)
 
 def _make_model(size:str, quantizers:int=4, tunables:Tunables=Tunables(), **kwargs):
     kwargs = dict(quantizers=quantizers, tunables=tunables, **kwargs)
@@ -0,0 +1,278 @@
+__all__ = ['Scheduler']
+
+import threading
+import traceback
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import Future
+
+import torch
+
+from whisperspeech2 import inference
+
+
+class _Request:
+    def __init__(self, text, speaker, lang, cps, seed):
+        self.text = text
+        self.speaker = speaker
+        self.lang = lang
+        self.cps = cps
+        self.seed = seed
+        self.generator = None
+        self.future = Future()
+        self.stoks = None
+        self.seq = None
+        self.pos = 0
+        self.end = 0
+        self.n = 0
+
+
+class Scheduler:
+    def __init__(self, pipe, max_batch_size=8, T=0.7, top_k=None, top_p=None, min_p=None, sync_every=4, vocode=True, quality=None):
+        self.pipe = pipe
+        self.t2s, self.s2a = pipe.t2s, pipe.s2a
+        self.bs = max_batch_size
+        self.T = T
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.sync_every = sync_every
+        self.vocode = vocode
+        self.eos_patience = pipe.eos_patience
+
+        # the scheduler drives the models' caches slot by slot, direct generate calls have to wait until it is closed
+        self._models = ExitStack()
+        self._models.enter_context(self.t2s._generating())
+        self._models.enter_context(self.s2a._generating())
+        self.t2s.ensure_tokenizer()
+        self.t2s._ensure_kv_cache(self.bs)
+        self.s2a._ensure_kv_cache(self.bs)
+        dev = self.t2s.device
+        self.rows = torch.arange(self.bs, device=dev)
+
+        self.t2s_queue = deque()
+        self.t2s_slots = [None] * self.bs
+        self.t2s_toks = torch.zeros((self.bs, self.t2s.stoks_len), dtype=torch.long, device=dev)
+        self.t2s_pos = torch.zeros(self.bs, dtype=torch.long, device=dev)
+        self.t2s_active = torch.zeros(self.bs, dtype=torch.long, device=dev)
+        self.t2s_xenc, self.t2s_cps = None, None
+        self.t2s_xenc_positions = torch.arange(self.t2s.ttoks_len, device=dev)
+        self.stop_tok = self.t2s.stoks_codes + self.t2s.tunables.padding_token_offset
+
+        q = self.quantizers = self.s2a._n_quantizers(pipe._n_quantizers(quality))
+        self.s2a_queue = deque()
+        self.s2a_slots = [None] * self.bs
+        self.s2a_toks = torch.full((self.bs, q, self.s2a.ctx_n), self.s2a.codes+1, dtype=torch.long, device=dev)
+        self.s2a_pos = torch.zeros(self.bs, dtype=torch.long, device=dev)
+        self.s2a_active = torch.zeros(self.bs, dtype=torch.long, device=dev)
+        self.s2a_padrun = torch.zeros(self.bs, dtype=torch.long, device=dev)
+        self.s2a_stop = torch.full((self.bs,), self.s2a.ctx_n, dtype=torch.long, device=dev)
+        self.s2a_xenc = None
+        self.s2a_xenc_positions = torch.arange(self.s2a.stoks_len, device=dev)
+        self.quantizer_ids = torch.arange(q, device=dev)
+
+        self.steps = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, text, speaker=None, lang='en', cps=15, seed=None):
+        req = _Request(text.replace("\n", " "), self.pipe._resolve_speaker(speaker), lang, cps, seed)
+        with self._cond:
+            if self._closed: raise RuntimeError("the scheduler is closed")
+            self.t2s_queue.append(req)
+            self._cond.notify()
+        return req.future
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._models.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _busy(self):
+        return (self.t2s_queue or self.s2a_queue or
+                any(r is not None for r in self.t2s_slots) or any(r is not None for r in self.s2a_slots))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._busy(): self._cond.wait()
+                if not self._busy(): return
+            try:
+                self.step()
+            except Exception as e:
+                traceback.print_exc()
+                self._fail_all(e)
+
+    def _fail_all(self, e):
+        with self._cond:
+            reqs = list(self.t2s_queue) + list(self.s2a_queue)
+            self.t2s_queue.clear()
+            self.s2a_queue.clear()
+        for slots, model, pos in [(self.t2s_slots, self.t2s, self.t2s_pos), (self.s2a_slots, self.s2a, self.s2a_pos)]:
+            for slot, r in enumerate(slots):
+                if r is None: continue
+                reqs.append(r)
+                self._free_slot(model, slots, slot, pos)
+        self.t2s_active.zero_()
+        self.s2a_active.zero_()
+        for r in reqs:
+            if not r.future.done(): r.future.set_exception(e)
+
+    def _free_slot(self, model, slots, slot, pos):
+        r = slots[slot]
+        slots[slot] = None
+        # idle rows keep decoding at position 0, a stale position would index past the token buffer and the block table
+        pos[slot] = 0
+        if model.kv_pool is not None:
+            model.kv_pool.release([r.seq])
+            model.kv_pool.activate([x and x.seq for x in slots])
+
+    def _take_slot(self, model, slots, slot, r):
+        slots[slot] = r
+        if r.seed is not None: r.generator = inference.make_generators(r.seed, 1, model.device)[0]
+        if model.kv_pool is not None:
+            r.seq = model.kv_pool.allocate(1)[0]
+            model.kv_pool.activate([x and x.seq for x in slots])
+
+    def _reserve(self, model, slots):
+        if model.kv_pool is None: return
+        for r in slots:
+            if r is not None: model.kv_pool.reserve([r.seq], r.pos + 1)
+
+    def _noise(self, slots, shape):
+        gens = [r and r.generator for r in slots]
+        if not any(g is not None for g in gens): return None
+        return inference.exponential_noise((self.bs,) + shape, self.t2s.device, gens)
+
+    def _pop(self, queue):
+        with self._cond:
+            return queue.popleft() if queue else None
+
+    @torch.no_grad()
+    def step(self):
+        self._admit_t2s()
+        self._admit_s2a()
+        limit = False
+        if any(r is not None for r in self.t2s_slots): limit |= self._t2s_step()
+        if any(r is not None for r in self.s2a_slots): limit |= self._s2a_step()
+        self.steps += 1
+        if limit or self.steps % self.sync_every == 0:
+            self._evict_t2s()
+            self._evict_s2a()
+
+    def _admit_t2s(self):
+        for slot in range(self.bs):
+            if self.t2s_slots[slot] is not None: continue
+            r = self._pop(self.t2s_queue)
+            if r is None: return
+            xenc, cps_emb = self.t2s.prefill_slot(slot, r.text, cps=r.cps, lang=r.lang)
+            if self.t2s_xenc is None:
+                self.t2s_xenc = xenc.new_zeros((self.bs,) + xenc.shape)
+                self.t2s_cps = cps_emb.new_zeros((self.bs,) + cps_emb.shape)
+            self.t2s_xenc[slot] = xenc
+            self.t2s_cps[slot] = cps_emb
+            self.t2s_toks[slot,0] = self.stop_tok
+            self.t2s_pos[slot] = 0
+            self.t2s_active[slot] = 1
+            r.pos = 0
+            self._take_slot(self.t2s, self.t2s_slots, slot, r)
+
+    def _t2s_step(self):
+        self._reserve(self.t2s, self.t2s_slots)
+        positions = self.t2s_pos[:,None]
+        toks = self.t2s_toks.gather(1, positions)
+        noise = self._noise(self.t2s_slots, (self.t2s.stoks_codes + 1,))
+        nxt = self.t2s.decode_slots(toks, positions, self.t2s_cps, self.t2s_xenc, self.t2s_xenc_positions, self.T, self.top_k, noise, self.top_p, self.min_p)
+        self.t2s_toks[self.rows, self.t2s_pos+1] = nxt[:,0].to(self.t2s_toks.dtype)
+        self.t2s_pos += self.t2s_active
+        limit = False
+        for r in self.t2s_slots:
+            if r is None: continue
+            r.pos += 1
+            limit |= r.pos >= self.t2s.stoks_len - 1
+        return limit
+
+    def _evict_t2s(self):
+        if all(r is None for r in self.t2s_slots): return
+        stops = self.t2s._stop_positions(self.t2s_toks, 2).tolist()
+        for slot, r in enumerate(self.t2s_slots):
+            if r is None: continue
+            if stops[slot] > r.pos and r.pos < self.t2s.stoks_len - 1: continue
+            r.stoks = self.t2s_toks[slot,1:min(stops[slot], r.pos+1)].clone()
+            self.t2s_active[slot] = 0
+            self._free_slot(self.t2s, self.t2s_slots, slot, self.t2s_pos)
+            with self._cond: self.s2a_queue.append(r)
+
+    def _admit_s2a(self):
+        for slot in range(self.bs):
+            if self.s2a_slots[slot] is not None: continue
+            r = self._pop(self.s2a_queue)
+            if r is None: return
+            stoks = self.s2a._trim_stoks(r.stoks) if self.eos_patience else r.stoks
+            N = len(stoks) * 3
+            r.n = max(N - 4, 0)
+            r.end = min(r.n + self.quantizers, self.s2a.ctx_n-1)
+            if r.n == 0:
+                self._finish(r, self.s2a._undelay(self.s2a_toks[slot], 0, 0))
+                continue
+            xenc = self.s2a.prefill_slot(slot, stoks, r.speaker)
+            if self.s2a_xenc is None:
+                self.s2a_xenc = xenc.new_zeros((self.bs,) + xenc.shape)
+            self.s2a_xenc[slot] = xenc
+            self.s2a_toks[slot] = self.s2a.codes+1
+            self.s2a_pos[slot] = 0
+            self.s2a_padrun[slot] = 0
+            self.s2a_stop[slot] = self.s2a.ctx_n
+            self.s2a_active[slot] = 1
+            r.pos = 0
+            self._take_slot(self.s2a, self.s2a_slots, slot, r)
+
+    def _s2a_step(self):
+        self._reserve(self.s2a, self.s2a_slots)
+        i = self.s2a_pos + 1
+        toks = self.s2a_toks[self.rows,:,self.s2a_pos]
+        noise = self._noise(self.s2a_slots, (self.quantizers, self.s2a.codes + 2))
+        out = self.s2a.decode_slots(toks[...,None], self.s2a_pos[:,None], self.s2a_xenc, self.s2a_xenc_positions, self.T, self.top_k, noise, self.top_p, self.min_p)
+        prev = self.s2a_toks[self.rows,:,i]
+        new = torch.where(self.quantizer_ids[None] < i[:,None], out[...,0].to(prev.dtype), prev)
+        self.s2a_toks[self.rows,:,i] = new
+        if self.eos_patience:
+            self.s2a_padrun = torch.where(new[:,0] == self.s2a.codes, self.s2a_padrun + 1, 0)
+            hit = (self.s2a_padrun >= self.eos_patience) & (self.s2a_stop == self.s2a.ctx_n)
+            self.s2a_stop = torch.where(hit, i - self.eos_patience, self.s2a_stop)
+        self.s2a_pos += self.s2a_active
+        limit = False
+        for r in self.s2a_slots:
+            if r is None: continue
+            r.pos += 1
+            limit |= r.pos + 1 >= r.end or r.pos >= r.n + self.quantizers - 1
+        return limit
+
+    def _evict_s2a(self):
+        if all(r is None for r in self.s2a_slots): return
+        stops = self.s2a_stop.tolist()
+        q = self.quantizers
+        for slot, r in enumerate(self.s2a_slots):
+            if r is None: continue
+            r.n = min(r.n, stops[slot])
+            if r.pos + 1 < r.end and r.pos < r.n + q - 1: continue
+            atoks = self.s2a._undelay(self.s2a_toks[slot], 0, r.n)
+            self.s2a_active[slot] = 0
+            self._free_slot(self.s2a, self.s2a_slots, slot, self.s2a_pos)
+            self._finish(r, atoks)
+
+    def _finish(self, r, atoks):
+        try:
+            r.future.set_result(self.pipe.vocoder.decode(atoks) if self.vocode else atoks)
+        except Exception as e:
+            r.future.set_exception(e)
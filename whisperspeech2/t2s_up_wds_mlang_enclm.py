@@ -4,6 +4,8 @@ import dataclasses
 import random
 import math
 import itertools
+import threading
+from contextlib import contextmanager
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -264,9 +266,17 @@ class TSARTransformer(nn.Module):
         self.static_xenc_positions = None
         self.static_T = None
         self.static_top_k = None
+        self.static_top_p = None
+        self.static_min_p = None
         self.static_output = None
         self.static_exponential_noise = None
         self.use_cuda_graph = False
+        self.length_buckets = None
+        self.kv_pool = None
+        self._kv_seqs = []
+        self._generation_lock = threading.Lock()
+        self.compiled_step = None
+        self.batch_buckets = None
 
         self.apply(self.init_transformer)
 
@@ -329,7 +339,7 @@ class TSARTransformer(nn.Module):
         x = (self.embeddings.embedding(in_stoks) + 
              self.embeddings.positional_embedding[in_stoks_positions] +
              cps_emb).to(xenc[0].dtype)
-        x = self.decoder(x, in_stoks_positions, xenc.clone(), xenc_positions)
+        x = self.decoder(x, in_stoks_positions, xenc, xenc_positions)
         logits = self.embeddings.embedding.unembed(x)
         logits = logits * self.tunables.output_mult / (self.width / self.base_width)
 
@@ -387,41 +397,38 @@ class TSARTransformer(nn.Module):
             for bn,b in m.named_buffers(recurse=False):
                 setattr(m,bn,b.to(dtype))
 
-    def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=False, use_cuda_graph=False):
+    def optimize(self, max_batch_size=1, dtype=None, torch_compile=False, use_cuda_graph=False, length_buckets=None,
+                 kv_cache_blocks=None, kv_block_size=64, batch_buckets=None, quantize=None):
         for emb in [self.embeddings.embedding, self.embeddings.embedding]:
             emb.convert_for_eval()
         for l in self.encoder.layers:
             l.attn.convert_for_eval()
+        self.kv_pool = PagedKVCache(kv_cache_blocks, kv_block_size, self.device) if kv_cache_blocks else None
         for l in self.decoder.layers:
             l.attn.convert_for_eval()
             l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len)
-        self.switch_dtypes(dtype)
+            l.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len, kv_pool=self.kv_pool)
+        if quantize == 'dynamic' and self.device.type == 'cpu': dtype = torch.float32
+        self.switch_dtypes(dtype or inference.get_inference_dtype(self.device))
+        if quantize: quantize_linears(self, quantize)
+        if use_cuda_graph and self.kv_pool is not None:
+            print("CUDA graphs are not supported with the paged KV cache. Falling back to standard inference.")
+            use_cuda_graph = False
         if use_cuda_graph and not (torch.cuda.is_available() and torch.version.cuda):
             print("CUDA graphs require an NVIDIA GPU with CUDA. Falling back to standard inference.")
             use_cuda_graph = False
         self.use_cuda_graph = use_cuda_graph
-        for l in self.decoder.layers:
-            if l.cross_attn is not None:
-                l.cross_attn._in_cuda_graph = use_cuda_graph
-        if torch_compile:
-            self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
+        self.length_buckets = length_buckets
+        self.batch_buckets = batch_buckets
+        if torch_compile and self.kv_pool is not None:
+            print("torch.compile is not supported with the paged KV cache. Falling back to standard inference.")
+            torch_compile = False
+        self.compiled_step = inference.CompiledStep(self.generate_one, self.device) if torch_compile else None
 
     def _sample_with_static_noise(self, logits, T, top_k):
-        T_val = T if isinstance(T, torch.Tensor) else torch.tensor(T, device=logits.device)
-        T_clamped = torch.clamp(T_val, min=1e-5)
-        logits = logits / T_clamped
-        
-        if top_k is not None:
-            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-            pivot = v.select(-1, -1).unsqueeze(-1)
-            logits = torch.where(logits < pivot, -float("Inf"), logits)
-        
-        probs = torch.nn.functional.softmax(logits, dim=-1)
-        self.static_exponential_noise.exponential_(1)
-        return torch.argmax(probs / self.static_exponential_noise, dim=-1, keepdim=True).to(dtype=torch.int)
+        return inference.gumbel_sample(logits, T, top_k, self.static_exponential_noise, self.static_top_p, self.static_min_p)
 
-    def _init_cuda_graph_buffers(self, bs, xenc, xenc_positions, cps_emb, T, top_k):
+    def _init_cuda_graph_buffers(self, bs, xenc, xenc_positions, cps_emb, T, top_k, top_p=None, min_p=None):
         dev = self.device
         self.static_toks = torch.zeros((bs, 1), dtype=torch.long, device=dev)
         self.static_positions = torch.zeros((1,), dtype=torch.long, device=dev)
@@ -430,15 +437,17 @@ class TSARTransformer(nn.Module):
         self.static_cps_emb = cps_emb.clone()
         self.static_T = T.clone() if isinstance(T, torch.Tensor) else torch.tensor(T, device=dev)
         self.static_top_k = top_k
+        self.static_top_p = top_p
+        self.static_min_p = min_p
         
         logits_shape = (bs, self.stoks_codes + 1)
-        self.static_exponential_noise = torch.empty(logits_shape, device=dev, dtype=torch.float32)
+        self.static_exponential_noise = torch.empty(logits_shape, device=dev, dtype=torch.float32).exponential_(1)
 
     def _generate_one_for_graph(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k):
         x = (self.embeddings.embedding(toks) + 
              self.embeddings.positional_embedding[toks_positions] +
              cps_emb).to(xenc[0].dtype)
-        x = self.decoder(x, toks_positions, xenc.clone(), xenc_positions)
+        x = self.decoder(x, toks_positions, xenc, xenc_positions)
         logits = self.embeddings.embedding.unembed(x)
         logits = logits * self.tunables.output_mult / (self.width / self.base_width)
         logits = logits[:,-1]
@@ -474,16 +483,62 @@ class TSARTransformer(nn.Module):
             )
         self.cuda_graph_warmup_done = True
 
-    def _cuda_graph_generate_one(self, toks, positions):
+    def _cuda_graph_generate_one(self, toks, positions, generators=None):
         self.static_toks.copy_(toks)
         self.static_positions.copy_(positions)
+        inference.exponential_noise(None, None, generators, out=self.static_exponential_noise)
         self.cuda_graph.replay()
         return self.static_output.clone()
 
-    def _update_static_buffers(self, xenc, xenc_positions, cps_emb):
+    def _update_static_buffers(self, xenc, xenc_positions, cps_emb, T):
         self.static_xenc.copy_(xenc)
         self.static_xenc_positions.copy_(xenc_positions)
         self.static_cps_emb.copy_(cps_emb)
+        self.static_T.copy_(T)
+
+    def _prepare_cuda_graph(self, bs, xenc, xenc_positions, cps_emb, T, top_k, top_p=None, min_p=None):
+        if not self.use_cuda_graph: return
+        if self.cuda_graph_warmup_done and (self.static_xenc.shape != xenc.shape or (self.static_top_k, self.static_top_p, self.static_min_p) != (top_k, top_p, min_p)):
+            self.reset_cuda_graph()
+        if not self.cuda_graph_warmup_done:
+            self._init_cuda_graph_buffers(bs, xenc, xenc_positions, cps_emb, T, top_k, top_p, min_p)
+            self._capture_cuda_graph()
+        else:
+            self._update_static_buffers(xenc, xenc_positions, cps_emb, T)
+
+    def _ensure_kv_cache(self, bs):
+        for l in self.decoder.layers:
+            if l.cross_attn.k_cache is not None and l.cross_attn.k_cache.shape[0] < bs:
+                if self.kv_pool is None:
+                    l.setup_kv_cache(bs, self.stoks_len, self.ttoks_len, dtype=self.dtype)
+                else:
+                    l.cross_attn.setup_kv_cache(bs, self.ttoks_len, dtype=self.dtype)
+                self.reset_cuda_graph()
+
+    def _kv_acquire(self, bs):
+        if self.kv_pool is None: return
+        self._kv_release()
+        self._kv_seqs = self.kv_pool.allocate(bs)
+        self.kv_pool.activate(self._kv_seqs)
+
+    def _kv_reserve(self, length):
+        if self.kv_pool is not None: self.kv_pool.reserve(self._kv_seqs, length)
+
+    def _kv_release(self):
+        if self.kv_pool is None or not self._kv_seqs: return
+        self.kv_pool.release(self._kv_seqs)
+        self._kv_seqs = []
+
+    @contextmanager
+    def _generating(self):
+        # the KV caches, CUDA graph buffers and pool sequences are model state, so a model runs one generation at a time
+        if not self._generation_lock.acquire(blocking=False):
+            raise RuntimeError(f"{type(self).__name__} is already generating, use a separate model instance for each concurrent caller")
+        try:
+            yield
+        finally:
+            self._kv_release()
+            self._generation_lock.release()
 
     def reset_cuda_graph(self):
         self.cuda_graph = None
@@ -495,6 +550,8 @@ class TSARTransformer(nn.Module):
         self.static_xenc_positions = None
         self.static_T = None
         self.static_top_k = None
+        self.static_top_p = None
+        self.static_min_p = None
         self.static_output = None
         self.static_exponential_noise = None
 
@@ -506,14 +563,39 @@ class TSARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k):
+    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, noise=None, top_p=None, min_p=None):
         probs, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb)
         probs = probs[:,-1]
         probs[:,self.embeddings.embedding.codes:] = -torch.inf
-        return inference.sample(probs, T, top_k)
+        return inference.sample(probs, T, top_k, noise, top_p, min_p)
 
-    def generate_next(self, *args, **kwargs):
-        return self.generate_one(*args, **kwargs)
+    def generate_next(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, noise=None, top_p=None, min_p=None):
+        if self.compiled_step is None:
+            return self.generate_one(toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, noise, top_p, min_p)
+        # unseeded steps get their noise drawn here too, so the compiled step is not specialized on noise being present
+        if noise is None: noise = inference.exponential_noise((toks.shape[0], self.stoks_codes + 1), self.device, None)
+        return self.compiled_step(toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, noise, top_p, min_p)
+
+    def _noise(self, bs, generators):
+        if generators is None: return None
+        return inference.exponential_noise((bs, self.stoks_codes + 1), self.device, generators)
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes=None, top_ks=(None,), T=0.7):
+        with self._generating():
+            dev = self.device
+            enc_lens = sorted({min(b, self.ttoks_len) for b in self.length_buckets or []} | {self.ttoks_len})
+            for bs, top_k, enc_len in itertools.product(batch_sizes or self.batch_buckets or [1], top_ks, enc_lens):
+                self._ensure_kv_cache(bs)
+                ttoks = torch.zeros((bs, enc_len), dtype=torch.long, device=dev)
+                xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, torch.zeros_like(ttoks), torch.full((bs,), 15, device=dev))
+                self.decoder.prefill_cross_kv(xenc, xenc_positions)
+                toks = torch.zeros((bs, 1), dtype=torch.long, device=dev)
+                self._kv_acquire(bs)
+                self._kv_reserve(3)
+                for i in range(3):
+                    self.generate_next(toks, torch.tensor([i], device=dev), cps_emb, xenc, xenc_positions, torch.tensor(T, device=dev), top_k)
+            if self.compiled_step is not None: self.compiled_step.warm = True
 
     @torch.no_grad()
     def prep(self, txt, cps=15, lang="en"):
@@ -525,94 +607,238 @@ class TSARTransformer(nn.Module):
         return ttoks, cpss, langs
 
     @torch.no_grad()
-    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, step=None, show_progress_bar=True):
-        self.ensure_tokenizer()
-        N = N or self.stoks_len
+    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, top_p=None, min_p=None, step=None, show_progress_bar=True, eos_check_every=8, seed=None):
+        with self._generating():
+            self.ensure_tokenizer()
+            N = N or self.stoks_len
+            dev = self.device
+            ttoks = []
+            langs = []
+            if isinstance(lang, list):
+                lang0 = lang[0]
+                assert isinstance(txt, list), "lang and txt have to be both lists or strings"
+                for txt, lang in zip(txt, lang):
+                    tt = self.tokenizer.encode(txt)
+                    ttoks += tt
+                    langs += [languages.to_id(lang)] * len(tt)
+            elif isinstance(lang, torch.Tensor):
+                langs = lang
+                ttoks = self.tokenizer.encode(txt)
+            else:
+                lang0 = lang
+                ttoks = self.tokenizer.encode(txt)
+                langs = torch.tensor([languages.to_id(lang)], device=dev)
+            ttoks_len = self._ttoks_bucket(len(ttoks), seed)
+            ttoks = torch.tensor(ttoks, device=dev)
+            ttoks = F.pad(ttoks, (1, ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot)
+            cpss = torch.tensor([cps], device=dev)
+            T = torch.tensor(T, device=dev)
+            if not isinstance(langs, torch.Tensor):
+                langs = torch.tensor(langs, device=dev)
+                langs = F.pad(langs, (1, ttoks_len - len(langs) - 1), value=languages.to_id(lang0))
+
+            self._ensure_kv_cache(bs)
+            toks = torch.zeros((bs,N), dtype=torch.long, device=dev)
+            toks[:,0] = self.stoks_codes + self.tunables.padding_token_offset
+            start = 0
+            if stoks_prompt is not None:
+                toks[:,1:len(stoks_prompt)+1] = stoks_prompt
+                start = len(stoks_prompt)
+            it = range(start+1,N-1)
+            if show_progress_bar: it = progress_bar(it)
+
+            toks_positions = torch.arange(N, device=dev)
+            ttoks = ttoks.repeat(bs, 1)
+            langs, cpss = [x.repeat(bs) for x in (langs, cpss)]
+            xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, langs, cpss)
+            toks_positions = torch.arange(N+1, device=dev)
+        
+            self.decoder.prefill_cross_kv(xenc, xenc_positions)
+            self._prepare_cuda_graph(bs, xenc, xenc_positions, cps_emb, T, top_k, top_p, min_p)
+
+            gens = inference.make_generators(seed, bs, dev)
+            self._kv_acquire(bs)
+            self._kv_reserve(start+1)
+            toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, xenc, xenc_positions, T, top_k, self._noise(bs, gens), top_p, min_p)[:,0]
+        
+            done = torch.zeros(bs, dtype=torch.bool, device=dev)
+            for i in it:
+                self._kv_reserve(i+1)
+                if self.use_cuda_graph and self.cuda_graph_warmup_done:
+                    toks[:,i+1] = self._cuda_graph_generate_one(toks[:,i:i+1], toks_positions[i:i+1], gens)[:,0]
+                else:
+                    toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k, self._noise(bs, gens), top_p, min_p)[:,0]
+                done |= toks[:,i+1] == self.stoks_codes+self.tunables.padding_token_offset
+                if (i - start) % eos_check_every == 0 and done.all(): break
+
+                if step is not None: step()
+            return toks[:,1:self._stop_positions(toks, start+2).max()]
+
+    def _stop_positions(self, toks, start):
+        hits = toks[:,start:] == self.stoks_codes + self.tunables.padding_token_offset
+        return torch.where(hits.any(-1), hits.int().argmax(-1) + start, toks.shape[-1])
+
+    def _ttoks_bucket(self, n, seed=None):
+        # the encoder output depends on the padded length, seeded calls always pad to the full context
+        # so that a request gives the same tokens alone and inside a batch
+        if seed is not None: return self.ttoks_len
+        return inference.bucket_length(n + 2, self.length_buckets, self.ttoks_len)
+
+    def _text_len(self, txt):
+        if isinstance(txt, list): return sum(len(self.tokenizer.encode(t)) for t in txt)
+        return len(self.tokenizer.encode(txt))
+
+    def _encode_text(self, txt, lang, ttoks_len=None):
         dev = self.device
-        ttoks = []
-        langs = []
+        ttoks_len = ttoks_len or self.ttoks_len
         if isinstance(lang, list):
-            lang0 = lang[0]
             assert isinstance(txt, list), "lang and txt have to be both lists or strings"
-            for txt, lang in zip(txt, lang):
-                tt = self.tokenizer.encode(txt)
+            ttoks, langs = [], []
+            for t, l in zip(txt, lang):
+                tt = self.tokenizer.encode(t)
                 ttoks += tt
-                langs += [languages.to_id(lang)] * len(tt)
-        elif isinstance(lang, torch.Tensor):
-            langs = lang
-            ttoks = self.tokenizer.encode(txt)
+                langs += [languages.to_id(l)] * len(tt)
+            lang0 = lang[0]
         else:
-            lang0 = lang
             ttoks = self.tokenizer.encode(txt)
-            langs = torch.tensor([languages.to_id(lang)], device=dev)
-        ttoks = torch.tensor(ttoks, device=dev)
-        ttoks = F.pad(ttoks, (1, self.ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot)
-        cpss = torch.tensor([cps], device=dev)
-        T = torch.tensor(T, device=dev)
-        if not isinstance(langs, torch.Tensor):
-            langs = torch.tensor(langs, device=dev)
-            langs = F.pad(langs, (1, self.ttoks_len - len(langs) - 1), value=languages.to_id(lang0))
-
-        toks = torch.zeros((bs,N), dtype=torch.long, device=dev)
-        toks[:,0] = self.stoks_codes + self.tunables.padding_token_offset
-        start = 0
-        if stoks_prompt is not None:
-            toks[:,1:len(stoks_prompt)+1] = stoks_prompt
-            start = len(stoks_prompt)
-        it = range(start+1,N-1)
-        if show_progress_bar: it = progress_bar(it)
-
-        toks_positions = torch.arange(N, device=dev)
-        ttoks = ttoks.repeat(bs, 1)
-        langs, cpss = [x.repeat(bs) for x in (langs, cpss)]
-        xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, langs, cpss)
-        toks_positions = torch.arange(N+1, device=dev)
-        
-        if self.use_cuda_graph and not self.cuda_graph_warmup_done:
-            self._init_cuda_graph_buffers(bs, xenc, xenc_positions, cps_emb, T, top_k)
-            self._capture_cuda_graph()
-        elif self.use_cuda_graph and self.cuda_graph_warmup_done:
-            self._update_static_buffers(xenc, xenc_positions, cps_emb)
+            langs = [languages.to_id(lang)] * len(ttoks)
+            lang0 = lang
+        ttoks = torch.tensor(ttoks, dtype=torch.long, device=dev)
+        ttoks = F.pad(ttoks, (1, ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot)
+        langs = torch.tensor(langs, dtype=torch.long, device=dev)
+        langs = F.pad(langs, (1, ttoks_len - len(langs) - 1), value=languages.to_id(lang0))
+        return ttoks, langs
 
-        for layer in self.decoder.layers:
-            if layer.cross_attn is not None:
-                layer.cross_attn._cross_cache_ready = False
+    @torch.no_grad()
+    def generate_batch(self, txts, cps=15, lang="en", N=None, T=0.7, top_k=None, top_p=None, min_p=None, step=None, show_progress_bar=True, eos_check_every=8, seed=None):
+        with self._generating():
+            self.ensure_tokenizer()
+            N = N or self.stoks_len
+            dev = self.device
+            bs = len(txts)
+            if not isinstance(cps, (list, tuple)): cps = [cps] * bs
+            if not isinstance(lang, (list, tuple)): lang = [lang] * bs
+            assert len(cps) == bs and len(lang) == bs, "cps and lang need one entry per text"
+            n_real = bs
+            bs = inference.batch_bucket(n_real, self.batch_buckets)
+            txts, cps, lang = [list(x) + [x[-1]] * (bs - n_real) for x in (txts, cps, lang)]
+
+            ttoks_len = self._ttoks_bucket(max(self._text_len(txt) for txt in txts), seed)
+            ttoks, langs = zip(*[self._encode_text(txt, l, ttoks_len) for txt, l in zip(txts, lang)])
+            ttoks, langs = torch.stack(ttoks), torch.stack(langs)
+            cpss = torch.tensor(cps, device=dev)
+            T = torch.tensor(T, device=dev)
+            stop_tok = self.stoks_codes + self.tunables.padding_token_offset
+
+            self._ensure_kv_cache(bs)
+            toks = torch.zeros((bs,N), dtype=torch.long, device=dev)
+            toks[:,0] = stop_tok
+            toks_positions = torch.arange(N+1, device=dev)
+            xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, langs, cpss)
+
+            self.decoder.prefill_cross_kv(xenc, xenc_positions)
+            self._prepare_cuda_graph(bs, xenc, xenc_positions, cps_emb, T, top_k, top_p, min_p)
+
+            gens = inference.make_generators(seed, bs, dev)
+            self._kv_acquire(bs)
+            self._kv_reserve(1)
+            toks[:,1] = self.generate_one(toks[:,:1], toks_positions[:1], cps_emb, xenc, xenc_positions, T, top_k, self._noise(bs, gens), top_p, min_p)[:,0]
+
+            done = torch.zeros(bs, dtype=torch.bool, device=dev)
+            it = range(1,N-1)
+            if show_progress_bar: it = progress_bar(it)
+            for i in it:
+                self._kv_reserve(i+1)
+                if self.use_cuda_graph and self.cuda_graph_warmup_done:
+                    toks[:,i+1] = self._cuda_graph_generate_one(toks[:,i:i+1], toks_positions[i:i+1], gens)[:,0]
+                else:
+                    toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k, self._noise(bs, gens), top_p, min_p)[:,0]
+                done |= toks[:,i+1] == stop_tok
+                if i % eos_check_every == 0 and done.all(): break
+
+                if step is not None: step()
+            return [toks[j,1:p] for j,p in enumerate(self._stop_positions(toks, 2).tolist()[:n_real])]
+
+    def _decode_logits(self, toks, positions, cps_emb, xenc, xenc_positions):
+        logits, _ = self(None, None, None, None, toks, in_stoks_positions=positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb)
+        logits[...,self.embeddings.embedding.codes:] = -torch.inf
+        return logits.float()
+
+    def _prefill_request(self, txt, cps, lang, seed=None):
+        ttoks, langs = self._encode_text(txt, lang, self._ttoks_bucket(self._text_len(txt), seed))
+        xenc, xenc_positions, cps_emb = self.run_encoder(ttoks[None], langs[None], torch.tensor([cps], device=self.device))
+        self.decoder.prefill_cross_kv(xenc, xenc_positions)
+        return cps_emb, xenc, xenc_positions
 
-        toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-        
-        for i in it:
-            if self.use_cuda_graph and self.cuda_graph_warmup_done:
-                toks[:,i+1] = self._cuda_graph_generate_one(toks[:,i:i+1], toks_positions[i:i+1])[:,0]
-            else:
-                toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-            if (toks[:,i+1] == self.stoks_codes+self.tunables.padding_token_offset).all(): return toks[:,1:i+1]
+    @torch.no_grad()
+    def prefill_slot(self, slot, txt, cps=15, lang="en"):
+        ttoks, langs = self._encode_text(txt, lang)
+        xenc, xenc_positions, cps_emb = self.run_encoder(ttoks[None], langs[None], torch.tensor([cps], device=self.device))
+        self.decoder.prefill_cross_kv(xenc, xenc_positions, rows=torch.tensor([slot], device=self.device))
+        return xenc[0], cps_emb[0]
 
-            if step is not None: step()
-        return toks[:,1:]
+    @torch.no_grad()
+    def decode_slots(self, toks, positions, cps_emb, xenc, xenc_positions, T, top_k, noise=None, top_p=None, min_p=None):
+        logits = self._decode_logits(toks, positions, cps_emb, xenc, xenc_positions)[:,-1]
+        return inference.sample(logits, T, top_k, noise, top_p, min_p)
 
     @torch.no_grad()
-    def generate_batch(self, txts, N=None, T=1.1, top_k=7, show_progress_bar=True):
-        self.ensure_tokenizer()
-        N = self.stoks_len
-        dev = self.device
-        ttoks = []
-        for txt in txts:
-            ttoks_ = torch.tensor(self.tokenizer.encode(txt), device=dev)
-            ttoks_ = F.pad(ttoks_, (0, self.ttoks_len - len(ttoks_)), value=self.tokenizer.eot).unsqueeze(0)
-            ttoks.append(ttoks_)
-        ttoks = torch.cat(ttoks, dim=0)
-        toks = torch.zeros((len(ttoks),N), dtype=torch.long, device=dev)
-        it = range(N)
-        if show_progress_bar: it = progress_bar(it)
-        for i in it:
-            p, _ = self(ttoks, toks[:,:i], loss=None)
-            last_p = p[:,-1]
-            if top_k:
-                last_p[last_p < torch.topk(last_p, top_k).values[:,-1,None]] = -torch.inf
-            tok = torch.multinomial((last_p / float(T)).softmax(-1), 1)
-            toks[:,i] = tok[:,0]
-            if (toks[:,i] == self.stoks_codes-1).all(): return toks[:,:i]
-        return toks
+    def generate_speculative(self, txt, draft, cps=15, lang="en", N=None, k=4, T=0.7, top_k=None, top_p=None, min_p=None, step=None, seed=None):
+        with self._generating(), draft._generating():
+            assert draft.stoks_codes == self.stoks_codes, "the draft model has to share the semantic token vocabulary"
+            self.ensure_tokenizer()
+            draft.ensure_tokenizer()
+            N = N or self.stoks_len
+            dev = self.device
+            stop_tok = self.stoks_codes + self.tunables.padding_token_offset
+            gens = inference.make_generators(seed, 1, dev)
+
+            self._ensure_kv_cache(1)
+            draft._ensure_kv_cache(1)
+            self._kv_acquire(1)
+            draft._kv_acquire(1)
+            target_ctx = self._prefill_request(txt, cps, lang, seed)
+            draft_ctx = draft._prefill_request(txt, cps, lang, seed)
+
+            toks = torch.zeros((1,N+k+1), dtype=torch.long, device=dev)
+            toks[:,0] = stop_tok
+            positions = torch.arange(N+k+1, device=dev)
+            # toks[:,:n+1] are final, the draft KV cache is valid below draft_n
+            n, draft_n = 0, 0
+            while n < N-1:
+                kk = min(k, N-1-n)
+                qs = []
+                for j in range(kk):
+                    draft._kv_reserve(n+j+1)
+                    logits = draft._decode_logits(toks[:,draft_n:n+j+1], positions[draft_n:n+j+1], *draft_ctx)[:,-1]
+                    q = inference.logits_to_probs(logits, T, top_k, top_p, min_p)
+                    toks[:,n+j+1] = inference.multinomial_sample_one_no_sync(q, self._noise(1, gens))[:,0]
+                    qs.append(q)
+                    draft_n = n+j+1
+                q = torch.stack(qs, dim=1)
+                self._kv_reserve(n+kk+1)
+                p = inference.logits_to_probs(self._decode_logits(toks[:,n:n+kk+1], positions[n:n+kk+1], *target_ctx), T, top_k, top_p, min_p)
+
+                proposed = toks[:,n+1:n+kk+1,None]
+                p_tok, q_tok = p[:,:kk].gather(-1, proposed)[...,0], q.gather(-1, proposed)[...,0]
+                u = torch.rand(p_tok.shape, device=dev, generator=gens and gens[0])
+                accepted = (u * q_tok < p_tok).int().cumprod(-1).sum().item()
+                if accepted < kk:
+                    residual = (p[:,accepted] - q[:,accepted]).clamp(min=0)
+                    norm = residual.sum(-1, keepdim=True)
+                    residual = torch.where(norm > 0, residual / norm.clamp(min=1e-12), p[:,accepted])
+                else:
+                    residual = p[:,kk]
+                toks[:,n+accepted+1] = inference.multinomial_sample_one_no_sync(residual, self._noise(1, gens))[:,0]
+                draft_n = min(draft_n, n+accepted+1)
+
+                new = toks[:,max(n+1,2):n+accepted+2]
+                n += accepted + 1
+                if step is not None:
+                    for _ in range(accepted + 1): step()
+                if (new == stop_tok).any(): break
+            n = min(n, N-1)
+            return toks[:,1:self._stop_positions(toks[:,:n+1], 2).max()]
 
 def _make_model(size:str, tunables:Tunables=Tunables(), dataset=None, **kwargs):
     kwargs = dict(stoks_len = dataset.stoks_len, ttoks_len = dataset.ttoks_len, tunables=tunables, **kwargs)